@@ -0,0 +1,284 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import wave
+from os import path
+
+"""
+
+Hardware-free benchmarks of the RFID poll, read and write paths and of the tap-to-play latency
+of the RFID handler, on a simulated MFRC522 with virtual NTAG213 tags (see rfid_sim.py).
+
+Poll cycles are run by RFIDHandler.poll_loop() on a reader simulated with air time and SPI bus time,
+so SPI transaction counts include the IRQ checks while waiting for the tag, and times include the
+reader timeouts and tag processing times a real reader would see. Both depend a little on the machine.
+Write SPI transaction counts are measured with instant command completion and are deterministic.
+
+Usage: python bench.py [--taps N] [--json] [--no-check]
+
+Exits with status 1 if a result exceeds its threshold in THRESHOLDS.
+
+"""
+
+# state and music files of the benchmark must not touch the real ones - set before importing settings
+BENCH_DIR = tempfile.mkdtemp(prefix='nfcmusik-bench-')
+os.environ['NFCMUSIK_STATE_DIR'] = path.join(BENCH_DIR, 'state')
+os.environ['NFCMUSIK_AUDIO_FILE_ROOT'] = path.join(BENCH_DIR, 'music')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import controller  # noqa: E402
+from rfid import RFID  # noqa: E402
+from rfid_sim import FakeGPIO, NTAG213, SimulatedMFRC522  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# GPIO pin of the simulated IRQ line
+PIN_IRQ = 18
+
+# time per SPI transfer of the simulated reader (microseconds)
+TRANSFER_US = 40
+
+# upper limits of benchmark results - SPI transactions of writes are exact, those of polls (which include IRQ
+# checks while waiting) and times (milliseconds) leave room for slow machines
+THRESHOLDS = dict(
+    spi_per_empty_poll=60,
+    spi_per_cached_poll=50,
+    spi_per_read_poll=130,
+    spi_per_write=322,
+    empty_poll_ms=40.,
+    cached_poll_ms=40.,
+    read_poll_ms=40.,
+    write_ms=150.,
+    tap_to_play_poll_p50_ms=600.,
+    tap_to_play_irq_p50_ms=300.,
+)
+
+
+def tag_for(payload, page):
+    """
+    Virtual tag holding payload (binary string) from page on
+    """
+    data = [ord(c) for c in controller.pad_payload(payload)]
+    return NTAG213(pages={page + i: data[4 * i: 4 * i + 4] for i in range(len(data) // 4)})
+
+
+class PollBenchHandler(controller.RFIDHandler):
+    """
+    RFID handler polling a simulated reader without pauses, stops after a number of poll cycles and records
+    SPI transactions and time of each cycle
+    """
+
+    def __init__(self, sim, gpio, cycles, cached, warmup=2):
+        """
+        sim -- simulated reader
+        gpio -- GPIO stand-in of the simulated reader
+        cycles -- number of poll cycles to record
+        cached -- use cached tag data, otherwise the tag is read in each cycle
+        warmup -- number of cycles to run before recording
+        """
+        super().__init__()
+        self.rfid_kwargs = dict(spi=sim, gpio=gpio)
+        self.detect_irq = False
+        self.sim = sim
+        self.cycles = cycles
+        self.cached = cached
+        self.warmup = warmup
+
+        # number of cycles run, SPI transactions and seconds per recorded cycle, (SPI transactions, time)
+        # at the start of the current cycle if it is recorded
+        self.polls = 0
+        self.transfers = []
+        self.times = []
+        self.cycle_start = None
+
+    def next_sleep(self):
+        """
+        Record the cycle that just ended - called by poll_loop() after each cycle
+        """
+        now = time.monotonic()
+        if self.cycle_start is not None:
+            transfers, start = self.cycle_start
+            self.transfers.append(self.sim.transfers - transfers)
+            self.times.append(now - start)
+
+        if not self.cached and self.full_uid is not None:
+            self.tag_cache.invalidate(self.full_uid)
+
+        self.polls += 1
+        if len(self.transfers) >= self.cycles:
+            self.stop_polling()
+        elif self.polls >= self.warmup:
+            self.cycle_start = (self.sim.transfers, time.monotonic())
+        return 0.
+
+
+def measure_polls(tag, cached, cycles):
+    """
+    Run RFIDHandler.poll_loop() on a simulated reader with air time and SPI bus time, with tag on the reader
+    (None for no tag). Returns (SPI transactions per cycle, milliseconds per cycle)
+    """
+    gpio = FakeGPIO()
+    sim = SimulatedMFRC522(gpio=gpio, transfer_us=TRANSFER_US)
+    if tag is not None:
+        sim.add_tag(tag)
+
+    handler = PollBenchHandler(sim, gpio, cycles, cached)
+    handler.poll_loop()
+
+    if tag is not None and handler.uid is None:
+        raise RuntimeError("Tag was not read")
+    return statistics.mean(handler.transfers), statistics.mean(handler.times) * 1000.
+
+
+def measure_write(handler, payload, air_time, writes):
+    """
+    Write and verify payload, return (SPI transactions per write, milliseconds per write)
+    """
+    gpio = FakeGPIO()
+    sim = SimulatedMFRC522(gpio=gpio, air_time=air_time)
+    sim.add_tag(NTAG213())
+    rdr = RFID(spi=sim, gpio=gpio)
+    data = [ord(c) for c in controller.pad_payload(payload)]
+
+    transactions = rdr.transactions
+    start = time.monotonic()
+    for _ in range(writes):
+        rdr.set_antenna(False)
+        rdr.set_antenna(True)
+        err, _ = rdr.request()
+        if not err:
+            err, uid = rdr.anticoll()
+        err = err or rdr.anticoll_full(uid)[0] or handler.program_tag(rdr, data)[0]
+        if err:
+            raise RuntimeError("Writing the tag failed")
+    elapsed = time.monotonic() - start
+
+    rdr.cleanup()
+    return (rdr.transactions - transactions) / writes, elapsed * 1000. / writes
+
+
+def write_silence(file_path, seconds):
+    with wave.open(file_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        f.writeframes(bytes(2 * 8000 * seconds))
+
+
+def measure_tap_to_play(detect_irq, taps):
+    """
+    Run the RFID handler poll loop, put tags on the reader at random times and measure the time until
+    the playback engine reports playing. Returns list of latencies (milliseconds).
+    """
+    gpio = FakeGPIO()
+    sim = SimulatedMFRC522(gpio=gpio, pin_irq=PIN_IRQ)
+
+    handler = controller.RFIDHandler()
+    handler.detect_irq = detect_irq
+    handler.rfid_kwargs = dict(spi=sim, gpio=gpio, pin_irq=PIN_IRQ if detect_irq else 0)
+
+    # two tags for two files, used alternately - the same file is not replayed right away
+    os.makedirs(controller.settings.MUSIC_ROOT, exist_ok=True)
+    music_files = dict()
+    tags = []
+    for i in range(2):
+        file_name = f'track{i}.wav'
+        write_silence(path.join(controller.settings.MUSIC_ROOT, file_name), 5)
+        payload = controller.music_file_hash(file_name)
+        music_files[payload] = file_name
+        tags.append((tag_for(payload, handler.page), path.join(controller.settings.MUSIC_ROOT, file_name)))
+    handler.set_music_files_dict(music_files)
+
+    thread = threading.Thread(target=handler.poll_loop, daemon=True)
+    thread.start()
+
+    latencies = []
+    try:
+        for i in range(taps):
+            time.sleep(random.uniform(0.5, 1.))
+            tag, file_path = tags[i % len(tags)]
+            placed = time.monotonic()
+            sim.add_tag(tag)
+
+            deadline = placed + 5.
+            while time.monotonic() < deadline:
+                with handler.mutex:
+                    state = handler.player.poll_state()
+                if state['status'] == 'playing' and state['file'] == file_path and state['time'] >= placed:
+                    latencies.append((state['time'] - placed) * 1000.)
+                    break
+                time.sleep(0.001)
+            else:
+                raise RuntimeError(f"Tap {i} did not start playing")
+
+            sim.remove_tag(tag)
+    finally:
+        handler.stop_polling()
+        thread.join()
+
+    return latencies
+
+
+def run(taps):
+    """
+    Run all benchmarks, return dictionary of results
+    """
+    handler = controller.RFIDHandler()
+    payload = controller.music_file_hash('track0.wav')
+    tag = tag_for(payload, handler.page)
+    full_payload = controller.encode_payload([(controller.CONTROL_BYTES['MUSIC_FILE'], 'x' * 55)])
+
+    results = dict()
+    results['spi_per_empty_poll'], results['empty_poll_ms'] = measure_polls(None, True, 20)
+    results['spi_per_cached_poll'], results['cached_poll_ms'] = measure_polls(tag, True, 20)
+    results['spi_per_read_poll'], results['read_poll_ms'] = measure_polls(tag, False, 20)
+    results['spi_per_write'], _ = measure_write(handler, full_payload, False, 10)
+
+    _, results['write_ms'] = measure_write(handler, full_payload, True, 5)
+
+    for mode, detect_irq in (('poll', False), ('irq', True)):
+        latencies = measure_tap_to_play(detect_irq, taps)
+        results[f'tap_to_play_{mode}_p50_ms'] = statistics.median(latencies)
+        results[f'tap_to_play_{mode}_max_ms'] = max(latencies)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hardware-free nfcmusik benchmarks")
+    parser.add_argument('--taps', type=int, default=10, help="tags put on the reader per tap-to-play benchmark")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--no-check', action='store_true', help="do not check results against thresholds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        results = run(args.taps)
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    failed = [name for name, value in results.items()
+              if not args.no_check and name in THRESHOLDS and value > THRESHOLDS[name]]
+
+    if args.json:
+        print(json.dumps(dict(results=results, thresholds=THRESHOLDS, failed=failed), indent=2))
+    else:
+        for name, value in results.items():
+            limit = THRESHOLDS.get(name)
+            status = '' if limit is None else ('FAIL' if name in failed else 'ok')
+            print(f"{name:28s} {value:10.2f} {'' if limit is None else f'{limit:10.2f}'} {status}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
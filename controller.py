@@ -1,20 +1,28 @@
 import binascii
+import ctypes
 import datetime
-import glob
 import hashlib
+import itertools
 import json
 import logging
+import queue
+import signal
 import subprocess
 import time
-from multiprocessing import Process, Lock, Manager
+from multiprocessing import Process, Lock, Queue, RawValue
 from os import path
 
-import pygame
-from flask import Flask, render_template, request
+from flask import Flask, Response, g, render_template, request
 
+import eventtrace
+import metrics
 import settings
 import util
-from rfid import RFID
+from library import ContentIds, MusicLibrary
+from player import PlaybackEngine, WarmCache
+from rfid import RFID, RFIDSession
+from tagcache import TagContentCache, UidMap
+from tagstate import SharedBatchState, SharedTagState
 
 logger = logging.getLogger(__name__)
 
@@ -33,14 +41,47 @@ Autostart: 'crontab -e', then add line
 # control bytes for NFC payload
 CONTROL_BYTES = dict(
     MUSIC_FILE='\x11',
+    TLV='\x12',
+    VOLUME='\x13',
+    PLAYLIST='\x14',
 )
 
+# volume tag modes (first value byte, second byte is the volume in percent or the signed step)
+VOLUME_SET = '\x00'
+VOLUME_STEP = '\x01'
+
+# length of legacy tag payloads: control byte and 15 bytes of identifier
+LEGACY_PAYLOAD_LENGTH = 16
+
+# maximum tag payload length, 15 NTAG pages - read with one FAST_READ command
+MAX_PAYLOAD_LENGTH = 60
+
+# TLV payload terminator
+TLV_TERMINATOR = '\xfe'
+
 # global debug output flag
 DEBUG = False
 
 # shut down wlan0 interface N seconds after startup (or last server interaction)
 WLAN_OFF_DELAY = 180
 
+# server-sent events: heartbeat interval (seconds) and client reconnect delay (milliseconds)
+SSE_HEARTBEAT = 15
+SSE_RETRY_MS = 3000
+
+# latency metrics of the polling process
+METRIC_MUTEX_WAIT = metrics.histogram('nfcmusik_mutex_wait_seconds', 'Time waiting for the RFID mutex',
+                                      dict(process='poll'))
+METRIC_WRITE_MUTEX_WAIT = metrics.histogram('nfcmusik_mutex_wait_seconds', 'Time waiting for the RFID mutex',
+                                            dict(process='web'))
+METRIC_POLL_CYCLE = metrics.histogram('nfcmusik_poll_cycle_seconds', 'Duration of RFID poll cycles, without sleep')
+METRIC_REQUEST = metrics.histogram('nfcmusik_rfid_request_seconds', 'Duration of RFID tag requests')
+METRIC_ANTICOLL = metrics.histogram('nfcmusik_rfid_anticoll_seconds', 'Duration of RFID anticollision')
+METRIC_READ = metrics.histogram('nfcmusik_rfid_read_seconds', 'Duration of RFID tag data reads')
+METRIC_ACTION = metrics.histogram('nfcmusik_action_seconds', 'Duration of acting on tag data')
+METRIC_POLLS = metrics.counter('nfcmusik_polls_total', 'Number of RFID poll cycles')
+METRIC_READ_ERRORS = metrics.counter('nfcmusik_rfid_errors_total', 'Number of failed RFID anticollisions and reads')
+
 
 class RFIDHandler(object):
     """
@@ -54,33 +95,136 @@ class RFIDHandler(object):
         # mutex for RFID access
         self.mutex = Lock()
 
-        # manager for interprocess data sharing (polling process writes uid/data)
-        self.manager = Manager()
+        # tag state shared with the web server (polling process writes uid/data)
+        self.state = SharedTagState(data_length=MAX_PAYLOAD_LENGTH)
+
+        # current tag uid and data (MAX_PAYLOAD_LENGTH bytes) as lists of byte values, None if no tag
+        # is present - only valid in the polling process
+        self.uid = None
+        self.data = None
+
+        # complete UID of the current tag (4 or 7 bytes, see RFID.anticoll_full()), None if no tag is present
+        self.full_uid = None
+
+        # tag data by complete UID - skip reading tag data while the same tag stays on the reader, and
+        # queue of complete UIDs of tags written outside the polling process, to drop them from the cache
+        self.tag_cache = TagContentCache(max_entries=64, ttl=30.)
+        self.tag_cache_invalidate_queue = Queue()
 
-        # current tag uid
-        self.uid = self.manager.list(range(5))
+        # persistent map of tag UID to data seen last - start playing from the UID alone,
+        # before the tag data is read
+        self.uid_map = UidMap(path.join(settings.STATE_DIR, 'uidmap.bin'), data_length=MAX_PAYLOAD_LENGTH)
 
-        # current tag data - 16 bytes
-        self.data = self.manager.list(range(16))
+        # music file started from the UID map, not yet confirmed by reading the tag
+        self.speculative_music = None
 
-        # music files dictionary
-        self.music_files_dict = self.manager.dict()
+        # time.monotonic() of the poll cycle that noticed the current tag
+        self.tag_time = None
+
+        # ring buffer of tag and playback events, written by the polling process
+        self.trace = eventtrace.EventTrace(settings.TRACE_EVENTS)
+
+        # batch tag programming: queue of commands for the polling process, progress shared with the web server,
+        # and source of batch ids (web server process)
+        self.batch_queue = Queue()
+        self.batch_state = SharedBatchState()
+        self.batch_ids = itertools.count(1)
+
+        # batch being programmed - only valid in the polling process: id, payloads (lists of byte values),
+        # number written, number of failed writes, UIDs written, UID written last
+        self.batch_id = 0
+        self.batch_payloads = None
+        self.batch_written = 0
+        self.batch_errors = 0
+        self.batch_uids = set()
+        self.batch_last_uid = None
+
+        # music files dictionary and its version, and queue for passing new versions to the polling process
+        self.music_files_dict = dict()
+        self.music_files_version = 0
+
+        # playlists dictionary: playlist hash -> (playlist path, list of music file paths), relative to the
+        # music root - passed along with the music files dictionary
+        self.playlists_dict = dict()
+        self.music_files_queue = Queue()
 
         # startup time or last server interaction
         self.startup = datetime.datetime.now()
 
         # flag for inter-process communication: reset the startup time
-        self.reset_startup = self.manager.Value('c', 0)
-        self.reset_startup.value = 0
+        self.reset_startup = RawValue(ctypes.c_byte, 0)
+
+        # flag for inter-process communication: the reader was used outside the polling
+        # process, re-initialise the polling session
+        self.reader_stale = RawValue(ctypes.c_byte, 0)
 
         # have we shut off WiFi already?
         self.is_wlan_off = False
 
-        # NFC memory page to use for reading/writing
+        # seconds since startup of the last WiFi shutdown countdown message
+        self.wlan_countdown = None
+
+        # NFC memory page to use for reading/writing, and number of pages holding the payload
         self.page = 10
+        self.n_pages = MAX_PAYLOAD_LENGTH // 4
+
+        # duration of last tag write including verification (seconds), None if not written
+        self.last_write_time = None
+
+        # polling cycle time (seconds): fast right after the tag state changed, backing off to
+        # the idle rate when nothing changed for fast_period seconds
+        self.sleep_fast = 0.05
+        self.sleep_idle = 0.5
+        self.fast_period = 3.0
+
+        # time of last tag state change (time.monotonic()) and last seen tag data
+        self.last_change = 0.
+        self.last_state = None
+
+        # tag detection mode: 'poll' - send a request every cycle, 'irq' - block on the reader IRQ pin
+        # while no tag is present, re-sending the request every irq_rearm seconds
+        self.detect_irq = settings.RFID_DETECT_MODE == 'irq'
+        self.irq_rearm = settings.RFID_IRQ_REARM
+
+        # arguments for setting up the reader (rfid.RFID), e.g. spi and gpio to use simulated hardware
+        self.rfid_kwargs = dict(hw_crc=settings.RFID_HW_CRC,
+                                shadow=settings.RFID_SHADOW,
+                                sleep_us=settings.RFID_IRQ_SLEEP_US,
+                                pin_irq=settings.RFID_PIN_IRQ if self.detect_irq else 0)
+
+        # replay a recording of SPI transfers instead of using the reader, or record them for diagnostics -
+        # the simulator is only imported when needed
+        if settings.SPI_REPLAY:
+            import spirecord
+            from rfid_sim import FakeGPIO
+
+            gpio = FakeGPIO()
+            exchanges = spirecord.extract_exchanges(spirecord.read_recording(settings.SPI_REPLAY))
+            self.rfid_kwargs.update(gpio=gpio,
+                                    spi=spirecord.ReplayMFRC522(exchanges, gpio=gpio,
+                                                                pin_irq=self.rfid_kwargs['pin_irq']))
+        elif settings.SPI_RECORD_DIR:
+            import spirecord
+
+            self.rfid_kwargs.update(spi=spirecord.SpiRecorder(settings.SPI_RECORD_DIR,
+                                                              max_bytes=int(settings.SPI_RECORD_MB * 1024 * 1024)))
+
+        # playback engine process, owns the music mixer; keeps heads of frequently played files in memory
+        if settings.AUDIO_CACHE_MB > 0:
+            audio_cache = WarmCache(max_bytes=int(settings.AUDIO_CACHE_MB * 1024 * 1024),
+                                    head_bytes=settings.AUDIO_CACHE_HEAD_KB * 1024,
+                                    prefetch_count=settings.AUDIO_CACHE_PREFETCH,
+                                    counts_path=path.join(settings.STATE_DIR, 'playcounts.json'))
+        else:
+            audio_cache = None
+        self.player = PlaybackEngine(cache=audio_cache)
+
+        # audio output volume, amixer session and ramp thread are started in the polling process
+        self.volume = util.VolumeController(control=settings.MIXER_CONTROL, ramp_time=settings.VOLUME_RAMP)
 
-        # polling cycle time (seconds)
-        self.sleep = 0.5
+        # UID of the volume tag applied last, None after a tag without volume record - apply each volume
+        # tag once per placement
+        self.volume_uid = None
 
         # music playing status
         self.current_music = None
@@ -88,89 +232,290 @@ class RFIDHandler(object):
         # last played music file
         self.previous_music = None
 
-        # must have seen stop signal N times to stop music - avoid
+        # must have seen no token for N seconds to stop music - avoid
         # stopping if signal drops out briefly
-        self.stop_music_on_stop_count = 3
+        self.stop_delay = 1.5
 
-        # to replay same music file, must have seen at least N periods
-        # of no token - avoid replaying if token is left on device
+        # to replay same music file, must have seen no token for at least
+        # N seconds - avoid replaying if token is left on device
         # but signal drops out briefly
-        self.replay_on_stop_count = 3
+        self.replay_delay = 1.5
 
-        # stop signal counter
-        self.stop_count = 0
+        # start of current token absence (time.monotonic()), None while token is present
+        self.absent_since = None
+
+        # duration of the last token absence (seconds)
+        self.absent_duration = 0.
 
     def poll_loop(self):
         """
         Poll for presence of tag, read data, until stop() is called.
         """
 
-        # initialize music mixer
-        pygame.mixer.init()
+        # start playback engine
+        self.player.start()
 
         # set default volume
-        util.set_volume(settings.DEFAULT_VOLUME)
+        self.volume.set(settings.DEFAULT_VOLUME, ramp=False)
+
+        # long-lived reader session, only re-initialised after errors or watchdog timeout
+        session = RFIDSession(max_errors=settings.RFID_MAX_ERRORS,
+                              watchdog=settings.RFID_WATCHDOG,
+                              **self.rfid_kwargs)
+
+        # a tag answered the request armed for IRQ detection, continue with anticoll()
+        tag_ready = False
+
+        self.uid_map.load()
 
         while not self.do_stop:
+            present = False
+
+            # time.monotonic() rather than METRIC_*.time(), which is 0 with metrics disabled - the cycle start
+            # is also the time a new tag was noticed
+            cycle_start = time.monotonic()
             with self.mutex:
+                METRIC_MUTEX_WAIT.observe_since(cycle_start)
+                METRIC_POLLS.inc()
 
                 # initialize tag state
-                self.uid[0] = None
-                self.data[0] = None
+                tag_uid = None
+                tag_data = None
 
-                # always create a new RFID interface instance, to clear any errors from previous operations
-                rdr = RFID()
+                self.update_music_files_dict()
+                self.update_tag_cache()
+                self.update_batch()
+
+                # re-initialise reader if it was used by another process
+                if self.reader_stale.value > 0:
+                    self.reader_stale.value = 0
+                    session.invalidate()
+
+                transactions = session.transactions
+                reads_saved = session.reads_saved
+                rdr = session.begin_cycle()
 
                 # check for presence of tag
-                err, _ = rdr.request()
+                if tag_ready:
+                    err = False
+                else:
+                    start = METRIC_REQUEST.time()
+                    err, _ = rdr.request()
+                    METRIC_REQUEST.observe_since(start)
 
                 if not err:
                     logger.debug("RFIDHandler poll_loop: Tag is present")
 
                     # tag is present, get UID
+                    start = METRIC_ANTICOLL.time()
                     err, uid = rdr.anticoll()
+                    METRIC_ANTICOLL.observe_since(start)
 
                     if not err:
-                        logger.debug(f"RFIDHandler poll_loop: Read UID: {uid}")
+                        logger.debug("RFIDHandler poll_loop: Read UID: %s", uid)
+
+                        # new tag: time it was noticed, for tap-to-sound latency
+                        if uid != self.uid:
+                            self.tag_time = cycle_start
+                            self.trace.record(eventtrace.TAG_SEEN, uid)
+
+                        # cached data is only used while the same tag stays on the reader, i.e. it answered
+                        # every cycle since it was read - then the cascade is not completed again
+                        data = None
+                        if uid == self.uid and self.full_uid is not None and \
+                                (self.batch_payloads is None or tuple(self.full_uid) in self.batch_uids):
+                            full_uid = self.full_uid
+                            data = self.tag_cache.get(full_uid)
+
+                        # complete UID and select the tag, which only accepts memory commands once selected -
+                        # cascade level 1 UIDs of NTAG21x only differ in two bytes
+                        if data is None:
+                            err, full_uid = rdr.anticoll_full(uid)
+                            if self.full_uid is not None and full_uid != self.full_uid:
+                                self.tag_cache.invalidate(self.full_uid)
+                            self.full_uid = full_uid
 
-                        # read data
-                        err, data = rdr.read(self.page)
+                        if err:
+                            pass
+                        elif self.batch_payloads is not None and tuple(full_uid) not in self.batch_uids:
+                            # batch programming: write next payload to each new tag
+                            err, data = self.write_batch(rdr, uid, full_uid)
+                        elif data is not None:
+                            err = False
+                        else:
+                            # tag seen before: start playing before reading - by complete UID, tags with
+                            # equal cascade level 1 UIDs are common
+                            predicted = self.uid_map.get(full_uid)
+                            if predicted is not None:
+                                self.play_speculative(uid, predicted)
+
+                            start = METRIC_READ.time()
+                            err, data = rdr.fast_read(self.page, self.page + self.n_pages - 1)
+                            METRIC_READ.observe_since(start)
+                            if not err:
+                                self.tag_cache.put(full_uid, data)
+                                self.uid_map.put(full_uid, data)
+
+                                if predicted is not None and data != predicted:
+                                    self.cancel_speculative()
+
+                            self.speculative_music = None
 
                         if not err:
-                            logger.debug(f"RFIDHandler poll_loop: Read tag data: {data}")
+                            logger.debug("RFIDHandler poll_loop: Read tag data: %s", data)
+
+                            session.ok()
+                            present = True
 
-                            # all good, store data to shared mem
-                            for i in range(5):
-                                self.uid[i] = uid[i]
-                            for i in range(16):
-                                self.data[i] = data[i]
+                            # all good, store data
+                            tag_uid = uid
+                            tag_data = data
 
                         else:
+                            session.error()
+                            METRIC_READ_ERRORS.inc()
+                            self.trace.record(eventtrace.READ_ERROR, uid, arg=eventtrace.STEP_READ)
                             logger.debug("RFIDHandler poll_loop: Error returned from read()")
 
                     else:
+                        session.error()
+                        METRIC_READ_ERRORS.inc()
+                        self.trace.record(eventtrace.READ_ERROR, arg=eventtrace.STEP_ANTICOLL)
                         logger.debug("RFIDHandler poll_loop: Error returned from anticoll()")
 
-                # clean up
-                rdr.cleanup()
+                # switch off RF field until next cycle
+                session.end_cycle()
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("RFIDHandler poll_loop: %d SPI transactions (%d saved by shadow cache), "
+                                 "session stats %s, tag cache stats %s",
+                                 session.transactions - transactions, session.reads_saved - reads_saved,
+                                 session.stats(), self.tag_cache.stats())
+
+                if tag_uid is None and self.uid is not None:
+                    self.trace.record(eventtrace.TAG_LOST, self.uid)
+
+                # tag gone or not readable, it may be rewritten elsewhere before it comes back
+                if tag_uid is None and self.full_uid is not None:
+                    self.tag_cache.invalidate(self.full_uid)
+                    self.full_uid = None
+
+                # publish tag state to shared mem
+                self.uid = tag_uid
+                self.data = tag_data
+                self.state.publish(tag_uid, tag_data)
+
+                # act on data, tags are only programmed while a batch runs
+                if self.batch_payloads is None:
+                    start = METRIC_ACTION.time()
+                    self.action()
+                    METRIC_ACTION.observe_since(start)
+
+                METRIC_POLL_CYCLE.observe_since(cycle_start)
+
+            # wait a bit (this is in while loop, NOT in mutex env), check for the next tag quickly
+            # while a batch runs
+            sleep = self.next_sleep()
+            if self.batch_payloads is not None:
+                sleep = self.sleep_fast
+            if self.detect_irq and not present:
+                tag_ready = self.wait_for_tag(session, sleep)
+            else:
+                tag_ready = False
+                time.sleep(sleep)
+
+        session.close()
+        self.player.shutdown()
+        self.volume.close()
 
-                # act on data
-                self.action()
+    def play_speculative(self, uid, data):
+        """
+        Act on tag data predicted from the UID - call this from within a mutex lock, after tag_time was set
+        """
+        self.uid = uid
+        self.data = data
+        current_music = self.current_music
+        self.action()
+        if self.current_music != current_music:
+            logger.debug("RFIDHandler play_speculative: started %s from UID", self.current_music)
+            self.speculative_music = self.current_music
+            self.trace.record(eventtrace.SPECULATIVE_PLAY, uid)
+
+    def cancel_speculative(self):
+        """
+        Stop music started by play_speculative(), tag data turned out to be different
+        """
+        if self.speculative_music is not None and self.speculative_music == self.current_music:
+            logger.info(f"Tag data changed, cancelling music file: {self.speculative_music}")
+            self.trace.record(eventtrace.SPECULATIVE_CANCEL, self.uid)
+            self.current_music = None
+            self.player.stop()
+
+    def next_sleep(self):
+        """
+        Get time to wait until next poll cycle: poll fast for a while after the tag state changed
+        """
+        state = tuple(self.data) if self.data is not None else None
+        now = time.monotonic()
+        if state != self.last_state:
+            self.last_state = state
+            self.last_change = now
+
+        if now - self.last_change < self.fast_period:
+            return self.sleep_fast
+        else:
+            return self.sleep_idle
+
+    def wait_for_tag(self, session, timeout):
+        """
+        Block on the reader IRQ pin until a tag answers, or timeout (seconds) passes. The request
+        is re-sent every irq_rearm seconds to catch tags placed in the meantime.
+        Returns True if a tag answered and is ready for anticoll().
+        """
+        deadline = time.monotonic() + timeout
 
-            # wait a bit (this is in while loop, NOT in mutex env)
-            time.sleep(self.sleep)
+        while not self.do_stop:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            with self.mutex:
+                if self.reader_stale.value > 0:
+                    return False
+                rdr = session.begin_cycle()
+                rdr.arm_tag_irq()
+
+            # wait for IRQ (NOT in mutex env)
+            if rdr.wait_tag_irq(min(remaining, self.irq_rearm)):
+                with self.mutex:
+                    if self.reader_stale.value > 0:
+                        return False
+                    err, _ = rdr.check_tag_irq()
+
+                logger.debug("RFIDHandler wait_for_tag: IRQ, tag answered: %s", not err)
+                return not err
+
+        return False
 
     def write(self, data):
         """
-        Write a 16-byte string of data to the tag
+        Write a string of data to the tag, padded to full pages, at most MAX_PAYLOAD_LENGTH bytes
         """
 
-        if len(data) != 16:
-            logger.debug(f"Illegal data length, expected 16, got {len(data)}")
+        if not 0 < len(data) <= MAX_PAYLOAD_LENGTH:
+            logger.debug(f"Illegal data length, expected 1 to {MAX_PAYLOAD_LENGTH}, got {len(data)}")
             return False
 
+        data = pad_payload(data)
+
+        self.last_write_time = None
+
+        start = METRIC_WRITE_MUTEX_WAIT.time()
         with self.mutex:
-            rdr = RFID()
+            METRIC_WRITE_MUTEX_WAIT.observe_since(start)
+
+            # IRQ pin is left to the polling process
+            rdr = RFID(**dict(self.rfid_kwargs, pin_irq=0))
 
             success = False
 
@@ -186,28 +531,19 @@ class RFIDHandler(object):
                 if not err:
                     logger.debug("RFIDHandler write: Read UID: " + str(uid))
 
-                    # write data: RFID lib writes 16 bytes at a time, but for NTAG213
-                    # only the first four are actually written
-                    err = False
-                    for i in range(4):
-                        page = self.page + i
-                        page_data = [ord(c) for c in data[4 * i: 4 * i + 4]] + [0] * 12
+                    # the tag only accepts WRITE once selected, at both cascade levels
+                    err, full_uid = rdr.anticoll_full(uid)
 
-                        # read data once (necessary for successful writing?)
-                        err_read, _ = rdr.read(page)
-
-                        if err:
-                            logger.debug("Error signaled on reading page {:d} before writing".format(page))
+                if not err:
+                    start = time.monotonic()
+                    err, _ = self.program_tag(rdr, [ord(c) for c in data])
 
-                        # write data
-                        err |= rdr.write(page, page_data)
+                    # tag content changed, cached data is stale
+                    self.tag_cache_invalidate_queue.put(full_uid)
 
-                        if err:
-                            logger.debug(f'Error signaled on writing page {page:d} with data {page_data:s}')
+                    self.last_write_time = time.monotonic() - start
 
                     if not err:
-                        logger.debug("RFIDHandler write: successfully wrote tag data")
-
                         success = True
 
                     else:
@@ -219,37 +555,185 @@ class RFIDHandler(object):
             # clean up
             rdr.cleanup()
 
+            # polling session has to set up the reader again
+            self.reader_stale.value = 1
+
             return success
 
+    def program_tag(self, rdr, tag_data):
+        """
+        Write tag_data (list of byte values, full pages) to the tag selected by RFID.anticoll_full() and verify it.
+        Returns tuple of (error state, payload read back).
+        """
+        # write data: NTAG21x WRITE command, one 4-byte page at a time
+        start = time.monotonic()
+        err = False
+        for i in range(len(tag_data) // 4):
+            page = self.page + i
+            err = rdr.ntag_write(page, tag_data[4 * i: 4 * i + 4])
+
+            if err:
+                logger.debug(f'Error signaled on writing page {page:d} with data {tag_data[4 * i: 4 * i + 4]}')
+                return err, None
+
+        # verify: read back the whole payload at once
+        write_done = time.monotonic()
+        err, read_data = rdr.fast_read(self.page, self.page + self.n_pages - 1)
+        if err:
+            return err, None
+
+        if read_data[:len(tag_data)] != tag_data:
+            logger.debug(f'Verification failed, read back {read_data}')
+            return True, None
+
+        logger.info(f"Wrote tag data in {(write_done - start) * 1000.:.1f} ms, "
+                    f"verified in {(time.monotonic() - write_done) * 1000.:.1f} ms")
+
+        return False, read_data
+
+    def start_batch(self, payloads):
+        """
+        Start programming tags with payloads (binary strings), one per tag put on the reader, in order -
+        replaces a running batch. Returns the batch id.
+        """
+        batch_id = next(self.batch_ids)
+        self.batch_queue.put(('start', batch_id, payloads))
+        return batch_id
+
+    def cancel_batch(self):
+        """
+        Stop programming tags
+        """
+        self.batch_queue.put(('cancel', None, None))
+
+    def update_batch(self):
+        """
+        Take over batch commands passed by start_batch() and cancel_batch(), call this from the polling process
+        """
+        try:
+            while True:
+                command, batch_id, payloads = self.batch_queue.get_nowait()
+
+                if command == 'start':
+                    logger.info(f"Starting batch {batch_id} of {len(payloads)} tags")
+                    self.batch_id = batch_id
+                    self.batch_payloads = [[ord(c) for c in pad_payload(data)] for data in payloads]
+                    self.batch_written = 0
+                    self.batch_errors = 0
+                    self.batch_uids = set()
+                    self.batch_last_uid = None
+                    self.publish_batch(SharedBatchState.RUNNING if payloads else SharedBatchState.DONE)
+
+                    if not payloads:
+                        self.batch_payloads = None
+
+                elif command == 'cancel' and self.batch_payloads is not None:
+                    logger.info(f"Cancelled batch {self.batch_id} after {self.batch_written} tags")
+                    self.publish_batch(SharedBatchState.CANCELLED)
+                    self.batch_payloads = None
+
+        except queue.Empty:
+            pass
+
+    def write_batch(self, rdr, uid, full_uid):
+        """
+        Write next payload of the running batch to the tag with UID uid (complete UID full_uid), advance
+        the batch if verified.
+        Call this from the polling process, within a mutex lock. Returns tuple of (error state, tag data).
+        """
+        err, data = self.program_tag(rdr, self.batch_payloads[self.batch_written])
+
+        if err:
+            # try again while the tag stays on the reader
+            self.batch_errors += 1
+            self.publish_batch(SharedBatchState.RUNNING)
+            return err, None
+
+        self.tag_cache.put(full_uid, data)
+        self.uid_map.put(full_uid, data)
+
+        self.batch_uids.add(tuple(full_uid))
+        self.batch_last_uid = uid
+        self.batch_written += 1
+
+        # user is at the web interface, keep WiFi on
+        self.startup = datetime.datetime.now()
+
+        if self.batch_written < len(self.batch_payloads):
+            self.publish_batch(SharedBatchState.RUNNING)
+        else:
+            logger.info(f"Finished batch {self.batch_id}, {self.batch_errors} failed writes")
+            self.publish_batch(SharedBatchState.DONE)
+            self.batch_payloads = None
+
+        return err, data
+
+    def publish_batch(self, state):
+        """
+        Publish batch progress to shared mem
+        """
+        self.batch_state.publish(self.batch_id, state, len(self.batch_payloads or []), self.batch_written,
+                                 self.batch_errors, self.batch_last_uid)
+
+    def get_tag(self):
+        """
+        Get consistent snapshot of current tag UID and data as tuple of binary strings,
+        (None, None) if no tag is present
+        """
+        uid, data, _ = self.state.snapshot()
+        return self.to_strings(uid, data)
+
+    @staticmethod
+    def to_strings(uid, data):
+        """
+        Convert tag UID and data from lists of byte values to binary strings
+        """
+        if uid is not None:
+            return "".join([chr(c) for c in uid]), "".join([chr(c) for c in data])
+        else:
+            return None, None
+
     def get_data(self):
         """
         Get current tag data as binary string
         """
-        with self.mutex:
-            data = list(self.data)
-        if data[0] is not None:
-            return "".join([chr(c) for c in data])
-        else:
-            return None
+        return self.get_tag()[1]
 
     def get_uid(self):
         """
         Get current tag UID
         """
-        with self.mutex:
-            uid = list(self.uid)
-        if uid[0] is not None:
-            return "".join([chr(c) for c in uid])
-        else:
-            return None
+        return self.get_tag()[0]
 
-    def set_music_files_dict(self, mfd):
+    def set_music_files_dict(self, mfd, version=0, playlists=None):
         """
-        Set dictionary of file hashes and music files
+        Set dictionary of file hashes and music files, and of playlist hashes and playlists - passed to the
+        polling process as one snapshot
         """
-        with self.mutex:
-            for k, v in mfd.items():
-                self.music_files_dict[k] = v
+        self.music_files_queue.put((version, dict(mfd), dict(playlists or dict())))
+
+    def update_music_files_dict(self):
+        """
+        Take over latest music files dictionary passed by set_music_files_dict(), call this from
+        the polling process
+        """
+        try:
+            while True:
+                self.music_files_version, self.music_files_dict, self.playlists_dict = \
+                    self.music_files_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def update_tag_cache(self):
+        """
+        Drop tags written outside the polling process from the tag cache, call this from
+        the polling process
+        """
+        try:
+            while True:
+                self.tag_cache.invalidate(self.tag_cache_invalidate_queue.get_nowait())
+        except queue.Empty:
+            pass
 
     def reset_startup_timer(self):
         """
@@ -280,55 +764,248 @@ class RFIDHandler(object):
             self.is_wlan_off = True
             subprocess.call(['sudo', 'ifdown', 'wlan0'])
 
-        if int(delta) % 10 == 0 and not self.is_wlan_off:
-            logger.info(f'Shutting down WiFi in (seconds): {WLAN_OFF_DELAY - delta}')
+        # count down every 10 seconds, once - action() runs several times per second
+        if int(delta) % 10 == 0 and int(delta) != self.wlan_countdown and not self.is_wlan_off:
+            self.wlan_countdown = int(delta)
+            logger.info('Shutting down WiFi in (seconds): %s', WLAN_OFF_DELAY - delta)
 
         # check if we have valid data
-        if self.data[0] is not None:
-            bin_data = "".join([chr(c) for c in self.data])
+        if self.data is not None:
+            str_data = "".join([chr(c) for c in self.data])
+            self.volume_action(payload_volume(str_data))
+            bin_data = payload_music_file(str_data)
+            if bin_data is None:
+                bin_data = payload_playlist(str_data)
 
-            if bin_data[0] == CONTROL_BYTES['MUSIC_FILE']:
+            if bin_data is not None:
 
                 if bin_data in self.music_files_dict:
                     file_name = self.music_files_dict[bin_data]
-                    file_path = path.join(settings.MUSIC_ROOT, file_name)
+                    file_paths = [path.join(settings.MUSIC_ROOT, file_name)]
+                elif bin_data in self.playlists_dict:
+                    file_name, tracks = self.playlists_dict[bin_data]
+                    file_paths = [path.join(settings.MUSIC_ROOT, track) for track in tracks]
+                else:
+                    file_name = None
+
+                if file_name is not None:
+                    file_path = file_paths[0] if file_paths else path.join(settings.MUSIC_ROOT, file_name)
+
+                    # token seen - end absence
+                    if self.absent_since is not None:
+                        self.absent_duration = time.monotonic() - self.absent_since
+                        self.absent_since = None
+                        self.trace.record(eventtrace.ABSENCE_END, self.uid,
+                                          min(int(self.absent_duration * 1000.), 0xFFFFFFFF))
 
                     if file_name != self.current_music:
 
-                        # only replay same music file if we saw at least N periods
-                        # of no token
-                        if path.exists(file_path) and (
-                                file_name != self.previous_music or self.stop_count >= self.replay_on_stop_count):
-                            logger.info(f'Playing music file: {file_path}')
+                        # only replay same music file if we saw no token for
+                        # at least N seconds
+                        if file_paths and path.exists(file_path) and (
+                                file_name != self.previous_music or self.absent_duration >= self.replay_delay):
 
-                            # play music file
+                            # play music file or playlist
                             self.current_music = file_name
                             self.previous_music = file_name
-                            pygame.mixer.music.load(file_path)
-                            pygame.mixer.music.play()
+                            if bin_data[0] == CONTROL_BYTES['PLAYLIST']:
+                                logger.info('Playing playlist: %s (%d files)', file_name, len(file_paths))
+                                self.player.play_playlist(file_paths, self.tag_time)
+                            else:
+                                logger.info('Playing music file: %s', file_path)
+                                self.player.play(file_path, self.tag_time)
+                            self.trace.record(eventtrace.PLAY, self.uid,
+                                              int.from_bytes(bin_data[1:5].encode('latin-1'), 'big'))
 
                         else:
                             if not path.exists(file_path):
-                                logger.debug(f'File not found: {file_path}')
-
-                    # token seen - reset stop counter
-                    self.stop_count = 0
+                                logger.debug('File not found: %s', file_path)
 
                 else:
-                    logger.debug('Got music file control byte, but unknown file hash')
-            else:
+                    logger.debug('Got music file or playlist control byte, but unknown hash')
+            elif self.volume_uid is None:
                 logger.debug('Unknown control byte')
         else:
-            self.stop_count += 1
+            now = time.monotonic()
+            if self.absent_since is None:
+                self.absent_since = now
+                self.trace.record(eventtrace.ABSENCE_START)
 
-            logger.debug(f"Resetting action status, stop count {self.stop_count}")
+            # apply the same volume tag again only after a real removal, not after a signal drop out
+            if now - self.absent_since >= self.replay_delay:
+                self.volume_uid = None
+
+            logger.debug("Resetting action status, token absent for %.2f s", now - self.absent_since)
+
+            # only stop after token absence for at least N seconds
+            if now - self.absent_since >= self.stop_delay:
+                if self.current_music is not None or self.player.poll_state()['status'] == 'playing':
+                    self.player.stop()
+                    self.trace.record(eventtrace.STOP, value=min(int((now - self.absent_since) * 1000.), 0xFFFFFFFF))
 
-            # only stop after token absence for at least N times
-            if self.stop_count >= self.stop_music_on_stop_count:
                 self.current_music = None
 
-                if pygame.mixer.music.get_busy():
-                    pygame.mixer.music.stop()
+    def volume_action(self, volume):
+        """
+        Apply volume record (mode, amount) of the current tag, or None, once per tag placement.
+
+        Music keeps playing while a volume tag is on the reader, it stops after the volume tag is removed
+        unless a music tag follows.
+        """
+        if volume is None:
+            self.volume_uid = None
+            return
+
+        if self.volume_uid == self.uid:
+            return
+        self.volume_uid = self.uid
+
+        mode, amount = volume
+        if mode == VOLUME_SET:
+            logger.info('Setting volume to %d%%', amount)
+            self.volume.set(amount)
+        else:
+            logger.info('Changing volume by %+d%%', amount)
+            self.volume.step(amount)
+
+
+def music_file_hash(file_name):
+    """
+    Get hash of music file name (path relative to the music root), replace first byte with a
+    control byte for music playing.
+    """
+    m = hashlib.md5()
+    m.update(file_name.encode('utf-8'))
+    return CONTROL_BYTES['MUSIC_FILE'] + m.digest()[1:].decode('latin-1')
+
+
+def playlist_hash(playlist_path):
+    """
+    Get hash of playlist (directory or playlist file path relative to the music root), replace first byte
+    with a control byte for playlists.
+    """
+    m = hashlib.md5()
+    m.update(playlist_path.encode('utf-8'))
+    return CONTROL_BYTES['PLAYLIST'] + m.digest()[1:].decode('latin-1')
+
+
+def music_content_hash(digest):
+    """
+    Get tag payload for a music file content digest, replace first byte with a control byte for music playing.
+    """
+    return CONTROL_BYTES['MUSIC_FILE'] + digest[1:].decode('latin-1')
+
+
+def encode_payload(records):
+    """
+    Encode a list of (control byte, value) records as TLV tag payload: TLV control byte, then for
+    each record its control byte, value length byte and value, then a terminator byte.
+    """
+    out = CONTROL_BYTES['TLV']
+    for control_byte, value in records:
+        if len(value) > 0xFD:
+            raise ValueError(f"TLV value too long: {len(value)} bytes")
+        out += control_byte + chr(len(value)) + value
+    out += TLV_TERMINATOR
+
+    if len(out) > MAX_PAYLOAD_LENGTH:
+        raise ValueError(f"Payload too long: {len(out)} bytes, maximum is {MAX_PAYLOAD_LENGTH}")
+
+    return out
+
+
+def decode_payload(data):
+    """
+    Decode tag payload (binary string) to a list of (control byte, value) records.
+
+    Legacy payloads (a control byte followed by 15 bytes of identifier) give a single record.
+    Decoding a TLV payload stops at the terminator, end of data or a truncated record.
+    """
+    if len(data) == 0:
+        return []
+
+    if data[0] != CONTROL_BYTES['TLV']:
+        return [(data[0], data[1:LEGACY_PAYLOAD_LENGTH])]
+
+    records = []
+    pos = 1
+    while pos + 1 < len(data) and data[pos] != TLV_TERMINATOR:
+        length = ord(data[pos + 1])
+        if pos + 2 + length > len(data):
+            break
+        records.append((data[pos], data[pos + 2: pos + 2 + length]))
+        pos += 2 + length
+
+    return records
+
+
+def pad_payload(data):
+    """
+    Pad tag payload (binary string) with zero bytes to full 4-byte pages
+    """
+    if len(data) % 4 != 0:
+        data += '\x00' * (4 - len(data) % 4)
+    return data
+
+
+def payload_music_file(data):
+    """
+    Get music file identifier (as in the music files dictionary) from tag payload, None if there is none
+    """
+    for control_byte, value in decode_payload(data):
+        if control_byte == CONTROL_BYTES['MUSIC_FILE']:
+            return control_byte + value
+
+    return None
+
+
+def payload_playlist(data):
+    """
+    Get playlist identifier (as in the playlists dictionary) from tag payload, None if there is none
+    """
+    for control_byte, value in decode_payload(data):
+        if control_byte == CONTROL_BYTES['PLAYLIST']:
+            return control_byte + value
+
+    return None
+
+
+def volume_payload(mode, amount):
+    """
+    Get tag payload for a volume tag - mode VOLUME_SET with a volume in percent (0-100), or VOLUME_STEP
+    with a change in percent (-100-100)
+    """
+    if mode == VOLUME_SET and not 0 <= amount <= 100:
+        raise ValueError(f"Volume must be in the range 0-100, got {amount}")
+    if mode == VOLUME_STEP and not -100 <= amount <= 100:
+        raise ValueError(f"Volume step must be in the range -100-100, got {amount}")
+    if mode not in (VOLUME_SET, VOLUME_STEP):
+        raise ValueError(f"Unknown volume mode: {to_hex(mode)}")
+
+    return encode_payload([(CONTROL_BYTES['VOLUME'], mode + chr(amount & 0xFF))])
+
+
+def payload_volume(data):
+    """
+    Get volume record from tag payload as tuple (mode, amount), None if there is none or it is invalid
+    """
+    for control_byte, value in decode_payload(data):
+        if control_byte == CONTROL_BYTES['VOLUME'] and len(value) >= 2:
+            mode = value[0]
+            amount = ord(value[1])
+            if mode == VOLUME_SET and amount <= 100:
+                return mode, amount
+            if mode == VOLUME_STEP:
+                return mode, amount - 0x100 if amount & 0x80 else amount
+
+    return None
+
+
+def to_hex(data):
+    """
+    Convert binary string to hex string
+    """
+    return binascii.b2a_hex(data.encode('latin-1')).decode()
 
 
 #
@@ -337,8 +1014,23 @@ class RFIDHandler(object):
 
 app = Flask(__name__)
 
-# global dictionary of music file hashes and names
-music_files_dict = dict()
+# music library index: relative file paths and their hashes, optionally identified by file contents
+if settings.TRACK_ID_MODE == 'content':
+    content_ids = ContentIds(path.join(settings.STATE_DIR, 'contentids.json'), music_content_hash)
+else:
+    content_ids = None
+
+library = MusicLibrary(settings.MUSIC_ROOT,
+                       path.join(settings.STATE_DIR, 'library.json'),
+                       music_file_hash,
+                       content_ids=content_ids,
+                       playlist_hash_function=playlist_hash)
+
+# music file list JSON output, and library version it was built for
+music_files_json = (None, None)
+
+# id of the batch started last and file names of its payloads
+batch_files = (None, [])
 
 # global RFID handler instance
 rfid_handler = RFIDHandler()
@@ -352,75 +1044,227 @@ rfid_polling_process = Process(target=rfid_handler.poll_loop)
 #
 
 
-def music_file_hash(file_name):
+def push_music_files():
     """
-    Get hash of music file name, replace first byte with a control byte for music playing.
+    Pass current library snapshot to the RFID handler
     """
-    m = hashlib.md5()
-    m.update(file_name)
-    return CONTROL_BYTES['MUSIC_FILE'] + m.digest()[1:]
+    version, files_by_hash, playlists = library.snapshot()
+    rfid_handler.set_music_files_dict(files_by_hash, version, playlists)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = metrics.Histogram.time()
+
+
+@app.after_request
+def observe_request_time(response):
+    """
+    Record duration of request handling (until the response object is returned, not until streaming ends)
+    """
+    if settings.METRICS and 'request_start' in g:
+        metrics.histogram('nfcmusik_http_request_seconds', 'Duration of HTTP request handling',
+                          dict(endpoint=request.endpoint)).observe_since(g.request_start)
+    return response
+
+
+@app.route("/json/metrics")
+def metrics_report():
+    """
+    Get latency histograms and counters of all processes as JSON, with p50 and p99 estimates, and
+    audio cache statistics.
+
+    GET arguments:
+    format -- 'json' (default) or 'prometheus' for the Prometheus text format
+    """
+    if request.args.get('format') == 'prometheus':
+        return Response(metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+    cache = rfid_handler.player.cache
+    return json.dumps(dict(enabled=settings.METRICS,
+                           audio_cache=cache.stats() if cache is not None else None,
+                           **metrics.report()))
+
+
+@app.route("/debug/trace")
+def trace_dump():
+    """
+    Download binary dump of the tag and playback event trace, decode it with eventtrace.py
+    """
+    return Response(rfid_handler.trace.dump(),
+                    mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=nfcmusik-trace.bin'})
+
+
+def write_trace_dump(signum, frame):
+    """
+    Signal handler: write binary dump of the event trace to the state directory
+    """
+    file_path = path.join(settings.STATE_DIR, f'trace-{datetime.datetime.now():%Y%m%d-%H%M%S}.bin')
+    try:
+        with open(file_path, 'wb') as f:
+            f.write(rfid_handler.trace.dump())
+        logger.info(f"Wrote event trace to {file_path}")
+    except OSError as e:
+        logger.warning(f"Could not write event trace: {e}")
 
 
 @app.route("/json/musicfiles")
 def music_files():
     """
-    Get a list of music files and file identifier hashes as JSON; also refresh 
-    internal cache of music files and hashes.
+    Get a list of music files and file identifier hashes as JSON. The library is refreshed in the background
+    and when the page is loaded.
     """
-    global music_files_dict
+    global music_files_json
 
-    file_paths = sorted(glob.glob(path.join(settings.MUSIC_ROOT, '*')))
+    version, out = music_files_json
+    if version != library.version:
+        files = sorted(library.files.items())
+        out = json.dumps([dict(name=file_name, hash=to_hex(file_hash)) for file_name, file_hash in files])
+        music_files_json = (library.version, out)
 
-    out = []
-    music_files_dict = dict()
-    for file_path in file_paths:
-        file_name = path.split(file_path)[1]
-        file_hash = music_file_hash(file_name)
-        out.append(dict(name=file_name,
-                        hash=binascii.b2a_hex(file_hash)))
-        music_files_dict[file_hash] = file_name
+    return out
 
-        # set music files dict in RFID handler
-        rfid_handler.set_music_files_dict(music_files_dict)
 
-    return json.dumps(out)
+@app.route("/json/library")
+def library_files():
+    """
+    Get a page of music files and file identifier hashes as JSON.
+
+    GET arguments:
+    q -- search string (case-insensitive)
+    match -- 'substring' (default) or 'prefix'
+    sort -- 'name' (default) or '-name' for descending order
+    cursor -- 'next' value of the previous page (the path of its last file, so that pages don't shift when
+              files are added or removed in between)
+    limit -- page size, default 100
+    format -- 'json' (default) or 'ndjson' to stream all matching files, one JSON object per line
+    """
+    query = request.args.get('q', '')
+    match = request.args.get('match', 'substring')
+    descending = request.args.get('sort', 'name') == '-name'
+    cursor = request.args.get('cursor') or None
 
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for file_name, file_hash in library.iter_files(query, match, descending, cursor):
+                yield json.dumps(dict(name=file_name, hash=to_hex(file_hash))) + '\n'
 
-@app.route("/json/readnfc")
-def read_nfc():
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+    except ValueError:
+        limit = 100
+
+    items, next_cursor = library.page(query, match, descending, cursor, limit)
+
+    return json.dumps(dict(items=[dict(name=file_name, hash=to_hex(file_hash)) for file_name, file_hash in items],
+                           next=next_cursor,
+                           cursor=cursor,
+                           total=library.count(query, match),
+                           version=library.version))
+
+
+@app.route("/json/playlists")
+def playlists():
     """
-    Get current status of NFC tag
+    Get a list of playlists (music directories and playlist files) with their identifier hashes and
+    number of music files as JSON
     """
-    global music_files_dict
+    _, _, playlists_by_hash = library.snapshot()
+    out = sorted((dict(name=name, hash=to_hex(playlist_hash), files=len(tracks))
+                  for playlist_hash, (name, tracks) in playlists_by_hash.items()),
+                 key=lambda p: p['name'].lower())
+    return json.dumps(out)
+
 
-    # get current NFC uid and data
+def tag_status(uid, data):
+    """
+    Get status of NFC tag with given UID and data (binary strings, None if no tag present) as dictionary
+    """
+    music_files_dict = library.files_by_hash
 
-    uid = rfid_handler.get_uid()
     if uid is None:
         hex_uid = "none"
     else:
-        hex_uid = binascii.b2a_hex(uid)
+        hex_uid = to_hex(uid)
 
-    data = rfid_handler.get_data()
     if data is None:
         hex_data = "none"
         description = "No tag present"
     else:
-        hex_data = binascii.b2a_hex(data)
+        hex_data = to_hex(data)
 
         description = 'Unknown control byte or tag empty'
-        if data[0] == CONTROL_BYTES['MUSIC_FILE']:
-            if data in music_files_dict:
-                description = 'Play music file ' + music_files_dict[data]
+        music_file = payload_music_file(data)
+        playlist = payload_playlist(data)
+        volume = payload_volume(data)
+        if music_file is not None:
+            if music_file in music_files_dict:
+                description = 'Play music file ' + music_files_dict[music_file]
             else:
                 description = 'Play a music file not currently present on the device'
+        elif playlist is not None:
+            if playlist in library.playlists_by_hash:
+                description = 'Play playlist ' + library.playlists_by_hash[playlist]
+            else:
+                description = 'Play a playlist not currently present on the device'
+        elif volume is not None:
+            if volume[0] == VOLUME_SET:
+                description = f'Set volume to {volume[1]}%'
+            else:
+                description = f'Change volume by {volume[1]:+d}%'
 
     # output container
-    out = dict(uid=hex_uid,
-               data=hex_data,
-               description=description)
+    return dict(uid=hex_uid,
+                data=hex_data,
+                description=description)
 
-    return json.dumps(out)
+
+@app.route("/json/readnfc")
+def read_nfc():
+    """
+    Get current status of NFC tag
+    """
+    uid, data = rfid_handler.get_tag()
+    return json.dumps(tag_status(uid, data))
+
+
+def event_stream(event, shared_state, status_function):
+    """
+    Stream changes of shared_state (SharedTagState or SharedBatchState) as server-sent events of type event,
+    with status_function(*snapshot without sequence number) as JSON content and the sequence number as id.
+    """
+    last_seq = request.headers.get('Last-Event-ID')
+
+    def generate(last_seq):
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+
+        while True:
+            *snapshot, seq = shared_state.snapshot()
+            if str(seq) != last_seq:
+                last_seq = str(seq)
+                yield f'id: {seq}\nevent: {event}\ndata: {json.dumps(status_function(*snapshot))}\n\n'
+
+            if not shared_state.wait_change(seq, SSE_HEARTBEAT):
+                yield ': heartbeat\n\n'
+
+    return Response(generate(last_seq),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route("/events/tag")
+def tag_events():
+    """
+    Stream NFC tag status changes as server-sent events (event type 'tag', same content as /json/readnfc).
+
+    The current status is sent on connect, unless the client reconnects with the id of the current status
+    in the Last-Event-ID header. Comment lines are sent as heartbeat while nothing changes.
+    """
+    return event_stream('tag', rfid_handler.state,
+                        lambda uid, data: tag_status(*rfid_handler.to_strings(uid, data)))
 
 
 @app.route("/actions/writenfc")
@@ -436,24 +1280,136 @@ def write_nfc():
         logger.error("No data argument given for writenfc endpoint")
         return
 
-    # convert from hex to bytes
-    data = binascii.a2b_hex(hex_data)
+    # convert from hex to binary string
+    data = binascii.a2b_hex(hex_data).decode('latin-1')
+    music_files_dict = library.files_by_hash
 
-    if data[0] == CONTROL_BYTES['MUSIC_FILE']:
-        if data not in music_files_dict:
+    if len(data) > MAX_PAYLOAD_LENGTH:
+        return json.dumps(dict(message=f"Payload too long, maximum is {MAX_PAYLOAD_LENGTH} bytes"))
+
+    music_file = payload_music_file(data)
+    if music_file is not None:
+        if music_file not in music_files_dict:
             return json.dumps(dict(message="Unknown hash value!"))
 
         # write tag
         success = rfid_handler.write(data)
 
         if success:
-            file_name = music_files_dict[data]
-            return json.dumps(dict(message="Successfully wrote NFC tag for file: " + file_name))
+            file_name = music_files_dict[music_file]
+            return json.dumps(dict(message=f"Successfully wrote NFC tag for file: {file_name} "
+                                           f"({rfid_handler.last_write_time * 1000.:.0f} ms)"))
+        else:
+            return json.dumps(dict(message="Error writing NFC tag data " + hex_data))
+
+    elif payload_playlist(data) is not None:
+        playlist = library.playlists_by_hash.get(payload_playlist(data))
+        if playlist is None:
+            return json.dumps(dict(message="Unknown hash value!"))
+
+        if rfid_handler.write(data):
+            return json.dumps(dict(message=f"Successfully wrote NFC tag for playlist: {playlist} "
+                                           f"({rfid_handler.last_write_time * 1000.:.0f} ms)"))
+        else:
+            return json.dumps(dict(message="Error writing NFC tag data " + hex_data))
+
+    elif payload_volume(data) is not None:
+        if rfid_handler.write(data):
+            return json.dumps(dict(message=f"Successfully wrote volume tag "
+                                           f"({rfid_handler.last_write_time * 1000.:.0f} ms)"))
         else:
             return json.dumps(dict(message="Error writing NFC tag data " + hex_data))
 
     else:
-        return json.dumps(dict(message='Unknown control byte: ' + binascii.b2a_hex(data[0])))
+        return json.dumps(dict(message='Unknown control byte: ' + to_hex(data[:1])))
+
+
+@app.route("/actions/batch/start", methods=['POST'])
+def start_batch():
+    """
+    Start programming tags in batch mode: each new tag put on the reader is written with the next payload.
+
+    Payloads are given as JSON object with a list of hex strings in 'data'.
+    """
+    global batch_files
+
+    args = request.get_json(silent=True)
+    hex_list = args.get('data', []) if isinstance(args, dict) else None
+    if not isinstance(hex_list, list):
+        return json.dumps(dict(message="Expected a JSON object with a list of hex strings in 'data'")), 400
+
+    music_files_dict = library.files_by_hash
+
+    payloads = []
+    file_names = []
+    for hex_data in hex_list:
+        try:
+            data = binascii.a2b_hex(hex_data).decode('latin-1')
+        except (TypeError, binascii.Error):
+            return json.dumps(dict(message="Illegal data " + str(hex_data))), 400
+
+        file_name = music_files_dict.get(payload_music_file(data)) or \
+            library.playlists_by_hash.get(payload_playlist(data))
+        if len(data) > MAX_PAYLOAD_LENGTH or file_name is None:
+            return json.dumps(dict(message="Unknown hash value: " + hex_data)), 400
+
+        payloads.append(data)
+        file_names.append(file_name)
+
+    if not payloads:
+        return json.dumps(dict(message="No data given for batch")), 400
+
+    batch_id = rfid_handler.start_batch(payloads)
+    batch_files = (batch_id, file_names)
+
+    return json.dumps(dict(message=f"Put {len(payloads)} tags on the reader, one after the other"))
+
+
+@app.route("/actions/batch/cancel")
+def cancel_batch():
+    """
+    Stop programming tags in batch mode
+    """
+    rfid_handler.cancel_batch()
+    return json.dumps(dict(message="Batch cancelled"))
+
+
+def batch_status(batch_id, state, total, written, errors, last_uid):
+    """
+    Get batch programming progress as dictionary
+    """
+    file_batch_id, file_names = batch_files
+    if batch_id != file_batch_id:
+        file_names = []
+
+    return dict(id=batch_id,
+                state={SharedBatchState.IDLE: 'idle',
+                       SharedBatchState.RUNNING: 'running',
+                       SharedBatchState.DONE: 'done',
+                       SharedBatchState.CANCELLED: 'cancelled'}[state],
+                total=total,
+                written=written,
+                errors=errors,
+                last_uid=to_hex("".join([chr(c) for c in last_uid])) if last_uid is not None else "none",
+                last=file_names[written - 1] if 0 < written <= len(file_names) else None,
+                next=file_names[written] if state == SharedBatchState.RUNNING and written < len(file_names) else None)
+
+
+@app.route("/json/batch")
+def batch():
+    """
+    Get batch programming progress
+    """
+    return json.dumps(batch_status(*rfid_handler.batch_state.snapshot()[:-1]))
+
+
+@app.route("/events/batch")
+def batch_events():
+    """
+    Stream batch programming progress as server-sent events (event type 'batch', same content as /json/batch),
+    see /events/tag.
+    """
+    return event_stream('batch', rfid_handler.batch_state, batch_status)
 
 
 @app.route("/")
@@ -461,15 +1417,28 @@ def home():
     # reset wlan shutdown counter when loading page
     rfid_handler.reset_startup_timer()
 
+    # pick up new music files before the page lists them, later they are picked up by library.watch()
+    library.refresh()
+
     return render_template("home.html")
 
 
 if __name__ == "__main__":
+    # dump event trace on SIGUSR1, to any of the processes
+    signal.signal(signal.SIGUSR1, write_trace_dump)
+
     # start RFID polling
     rfid_polling_process.start()
 
-    # initialize music files dict
-    music_files()
+    # initialize music files dict, keep it up to date
+    if content_ids is not None:
+        content_ids.load()
+    library.load()
+    library.on_change = push_music_files
+    if not library.refresh():
+        push_music_files()
+    library.check_contents()
+    library.watch(settings.LIBRARY_SCAN_INTERVAL)
 
     # run server
     app.run(host=settings.SERVER_HOST_MASK,
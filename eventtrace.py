@@ -0,0 +1,146 @@
+import ctypes
+import datetime
+import struct
+import sys
+import time
+from multiprocessing import RawArray, RawValue
+
+"""
+
+Binary ring buffer of tag and playback events, shared between the RFID polling process (the only
+writer) and the web server, which dumps it on request. Recording an event packs a fixed-size record
+into preallocated shared memory, no strings are formatted and nothing is written to disk.
+
+Decode a dump with: python eventtrace.py <dump file>
+
+"""
+
+# event types
+TAG_SEEN = 1
+TAG_LOST = 2
+READ_ERROR = 3
+PLAY = 4
+STOP = 5
+ABSENCE_START = 6
+ABSENCE_END = 7
+SPECULATIVE_PLAY = 8
+SPECULATIVE_CANCEL = 9
+
+EVENT_NAMES = {
+    TAG_SEEN: 'tag_seen',
+    TAG_LOST: 'tag_lost',
+    READ_ERROR: 'read_error',
+    PLAY: 'play',
+    STOP: 'stop',
+    ABSENCE_START: 'absence_start',
+    ABSENCE_END: 'absence_end',
+    SPECULATIVE_PLAY: 'speculative_play',
+    SPECULATIVE_CANCEL: 'speculative_cancel',
+}
+
+# READ_ERROR arguments: failed step
+STEP_ANTICOLL = 1
+STEP_READ = 2
+
+# record: time.monotonic(), event type, argument, 5 UID bytes, unsigned 32 bit value
+RECORD = struct.Struct('<dBB5BxI')
+
+# dump header: magic, format version, record size, number of records, dump time (wall clock and time.monotonic())
+HEADER = struct.Struct('<4sBBxxIdd')
+MAGIC = b'NFCT'
+VERSION = 1
+
+NO_UID = (0, 0, 0, 0, 0)
+
+
+class EventTrace(object):
+    """
+    Fixed-size ring buffer of event records in shared memory, for a single writer process
+    """
+
+    def __init__(self, capacity):
+        """
+        capacity -- number of events kept (the last capacity - 1 are dumped), 0 to disable tracing
+        """
+        self.capacity = capacity
+        self.buffer = RawArray(ctypes.c_char, max(capacity, 1) * RECORD.size)
+
+        # number of events recorded so far, the next one goes to slot count % capacity
+        self.count = RawValue(ctypes.c_uint64, 0)
+
+    def record(self, event, uid=None, value=0, arg=0):
+        """
+        Record event - uid is a list of 5 byte values or None, value an unsigned 32 bit integer
+        """
+        if self.capacity == 0:
+            return
+
+        count = self.count.value
+        if uid is None or len(uid) != 5:
+            uid = NO_UID
+        RECORD.pack_into(self.buffer, (count % self.capacity) * RECORD.size,
+                         time.monotonic(), event, arg, uid[0], uid[1], uid[2], uid[3], uid[4], value)
+        self.count.value = count + 1
+
+    def dump(self):
+        """
+        Get consistent copy of all recorded events, oldest first, as binary dump with header
+        """
+        if self.capacity == 0:
+            return HEADER.pack(MAGIC, VERSION, RECORD.size, 0, time.time(), time.monotonic())
+
+        before = self.count.value
+        buffer = bytes(self.buffer)
+        after = self.count.value
+
+        # records written while copying may be torn, and so may record number after, which may be being
+        # written to the slot of record number after - capacity
+        first = max(0, after - self.capacity + 1)
+        records = [buffer[(i % self.capacity) * RECORD.size: (i % self.capacity + 1) * RECORD.size]
+                   for i in range(first, before)]
+
+        return HEADER.pack(MAGIC, VERSION, RECORD.size, len(records), time.time(), time.monotonic()) + \
+            b''.join(records)
+
+
+def decode(dump):
+    """
+    Decode binary dump to list of events, as tuples (wall clock time as datetime, event name, argument,
+    UID as hex string or None, value)
+    """
+    magic, version, record_size, n_records, wall_time, monotonic_time = HEADER.unpack_from(dump)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError("Not an event trace dump, or unsupported version")
+
+    events = []
+    for i in range(n_records):
+        t, event, arg, *uid, value = RECORD.unpack_from(dump, HEADER.size + i * RECORD.size)
+        events.append((datetime.datetime.fromtimestamp(wall_time - (monotonic_time - t)),
+                       EVENT_NAMES.get(event, str(event)),
+                       arg,
+                       bytes(uid).hex() if tuple(uid) != NO_UID else None,
+                       value))
+
+    return events
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python eventtrace.py <dump file>")
+        return 1
+
+    with open(sys.argv[1], 'rb') as f:
+        dump = f.read()
+
+    previous = None
+    for t, event, arg, uid, value in decode(dump):
+        delta = '' if previous is None else f'+{(t - previous).total_seconds() * 1000.:.1f} ms'
+        previous = t
+        print(f"{t.isoformat(timespec='milliseconds')} {delta:>12s} {event:18s} "
+              f"uid={uid or '-':10s} arg={arg} value={value} (0x{value:08x})")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
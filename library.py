@@ -0,0 +1,647 @@
+import binascii
+import bisect
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+logger = logging.getLogger(__name__)
+
+"""
+
+Music library index.
+
+"""
+
+# extensions of playlist files, lists of music file paths relative to the playlist
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8')
+
+
+class MusicLibrary(object):
+    """
+    Index of the music files below a root directory, including subdirectories.
+
+    The index is persisted to disk and updated incrementally: a directory is only listed again if
+    its modification time changed (adding, removing or renaming an entry changes the modification
+    time of the containing directory), unchanged directories cost a single stat() call.
+    Each change of the index increments the version number.
+
+    Playlists are the subdirectories holding music files, played in case-insensitive name order, and playlist files
+    (.m3u, .m3u8), which are read when the index changes and are not listed as music files.
+    """
+
+    def __init__(self, root, index_path, hash_function, content_ids=None, playlist_hash_function=None):
+        """
+        root -- music root directory
+        index_path -- file to persist the index to
+        hash_function -- function mapping a file path relative to root to its tag payload
+        content_ids -- ContentIds for content-based tag payloads, None to identify files by name only
+        playlist_hash_function -- function mapping a playlist path relative to root to its tag payload,
+                                  None to not index playlists
+        """
+        self.root = root
+        self.index_path = index_path
+        self.hash_function = hash_function
+        self.playlist_hash_function = playlist_hash_function
+
+        self.content_ids = content_ids
+        if content_ids is not None:
+            content_ids.on_change = self.content_changed
+
+        # called without arguments after the index changed
+        self.on_change = None
+
+        # relative directory path ('' for root) -> dict(mtime=..., files=[names], subdirs=[names])
+        self.dirs = dict()
+
+        # relative file path -> name-based tag payload
+        self.name_hashes = dict()
+
+        # relative file path -> tag payload for writing tags, and all known tag payloads -> relative file path
+        self.files = dict()
+        self.files_by_hash = dict()
+
+        # relative file paths sorted case-insensitively, as list of sort_key() tuples
+        self.listing = []
+
+        # index version and (query, match) -> number of matching files, see count()
+        self.counts = (0, dict())
+
+        # relative playlist path -> tag payload, tag payload -> relative playlist path, and
+        # relative playlist path -> list of relative file paths
+        self.playlists = dict()
+        self.playlists_by_hash = dict()
+        self.playlist_tracks = dict()
+
+        # index version, incremented on every change
+        self.version = 0
+
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load index from disk
+        """
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read library index {self.index_path}: {e}")
+            return
+
+        with self.lock:
+            self.dirs = index.get('dirs', dict())
+            self.version = index.get('version', 0)
+            self.update_files()
+
+    def save(self):
+        """
+        Write index to disk
+        """
+        try:
+            os.makedirs(path.dirname(self.index_path), exist_ok=True)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(version=self.version, dirs=self.dirs), f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not write library index {self.index_path}: {e}")
+
+    def refresh(self):
+        """
+        Bring index up to date with the file system. Returns True if anything changed.
+        """
+        with self.lock:
+            start = time.monotonic()
+            dirs = dict()
+            changed = self.scan('', dirs)
+
+            # directories that were removed
+            changed |= dirs.keys() != self.dirs.keys()
+
+            if changed:
+                self.dirs = dirs
+                self.version += 1
+                self.update_files()
+                self.save()
+
+                logger.info(f"Music library updated in {time.monotonic() - start:.2f} s: "
+                            f"{len(self.files)} files, version {self.version}")
+
+        if changed:
+            if self.content_ids is not None:
+                self.content_ids.update(self.root, self.name_hashes)
+            if self.on_change is not None:
+                self.on_change()
+
+        return changed
+
+    def check_contents(self):
+        """
+        Schedule hashing of files whose contents are not known or changed, e.g. after startup
+        """
+        if self.content_ids is not None:
+            self.content_ids.update(self.root, self.name_hashes)
+
+    def content_changed(self):
+        """
+        Content-based identifiers were added, called by ContentIds
+        """
+        with self.lock:
+            self.version += 1
+            self.update_files()
+
+        if self.on_change is not None:
+            self.on_change()
+
+    def scan(self, rel_dir, dirs):
+        """
+        Scan directory rel_dir and its subdirectories into dirs, listing only changed directories.
+        Returns True if any directory changed.
+        """
+        abs_dir = path.join(self.root, rel_dir)
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+        except OSError:
+            return False
+
+        entry = self.dirs.get(rel_dir)
+        changed = entry is None or entry['mtime'] != mtime
+
+        if changed:
+            files = []
+            subdirs = []
+            try:
+                with os.scandir(abs_dir) as it:
+                    for dir_entry in it:
+                        if dir_entry.name.startswith('.'):
+                            continue
+                        if dir_entry.is_dir():
+                            subdirs.append(dir_entry.name)
+                        elif dir_entry.is_file():
+                            files.append(dir_entry.name)
+            except OSError as e:
+                logger.warning(f"Could not list music directory {abs_dir}: {e}")
+            entry = dict(mtime=mtime, files=sorted(files), subdirs=sorted(subdirs))
+
+        dirs[rel_dir] = entry
+
+        for subdir in entry['subdirs']:
+            changed |= self.scan(path.join(rel_dir, subdir), dirs)
+
+        return changed
+
+    def update_files(self):
+        """
+        Rebuild file dictionaries from directory index, re-using known hashes
+        """
+        self.update_playlists()
+
+        name_hashes = dict()
+        for rel_dir, entry in self.dirs.items():
+            for name in entry['files']:
+                if is_playlist_file(name):
+                    continue
+                rel_path = path.join(rel_dir, name)
+                file_hash = self.name_hashes.get(rel_path)
+                name_hashes[rel_path] = file_hash if file_hash is not None else self.hash_function(rel_path)
+
+        files_by_hash = {v: k for k, v in name_hashes.items()}
+
+        listing = sorted(sort_key(rel_path) for rel_path in name_hashes)
+
+        if self.content_ids is None:
+            self.name_hashes = name_hashes
+            self.files = name_hashes
+            self.files_by_hash = files_by_hash
+            self.listing = listing
+            return
+
+        # content-based payloads where known, plus aliases of payloads the content was known by before
+        files = dict()
+        for rel_path, name_hash in name_hashes.items():
+            content_id = self.content_ids.lookup(rel_path)
+            files[rel_path] = content_id if content_id is not None else name_hash
+            if content_id is not None:
+                files_by_hash[content_id] = rel_path
+
+        for alias, content_id in self.content_ids.aliases_items():
+            rel_path = files_by_hash.get(content_id)
+            if rel_path is not None:
+                files_by_hash.setdefault(alias, rel_path)
+
+        self.name_hashes = name_hashes
+        self.files = files
+        self.files_by_hash = files_by_hash
+        self.listing = listing
+
+    def update_playlists(self):
+        """
+        Rebuild playlist dictionaries from directory index, reading playlist files
+        """
+        if self.playlist_hash_function is None:
+            return
+
+        tracks = dict()
+        for rel_dir, entry in self.dirs.items():
+            music_files = sorted((path.join(rel_dir, name) for name in entry['files'] if not is_playlist_file(name)),
+                                 key=sort_key)
+            if rel_dir and music_files:
+                tracks[rel_dir] = music_files
+
+        for rel_dir, entry in self.dirs.items():
+            for name in entry['files']:
+                if is_playlist_file(name):
+                    rel_path = path.join(rel_dir, name)
+                    tracks[rel_path] = self.read_playlist(rel_path)
+
+        playlists = {rel_path: self.playlists.get(rel_path) or self.playlist_hash_function(rel_path)
+                     for rel_path in tracks}
+
+        self.playlists = playlists
+        self.playlists_by_hash = {v: k for k, v in playlists.items()}
+        self.playlist_tracks = tracks
+
+    def read_playlist(self, rel_path):
+        """
+        Read playlist file, return list of relative paths of the music files in it that are in the index
+        """
+        rel_dir = path.dirname(rel_path)
+        try:
+            with open(path.join(self.root, rel_path), encoding='utf-8', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            logger.warning(f"Could not read playlist {rel_path}: {e}")
+            return []
+
+        tracks = []
+        for line in lines:
+            line = line.strip().lstrip('\ufeff')
+            if not line or line.startswith('#'):
+                continue
+            if path.isabs(line):
+                track = path.relpath(line, self.root)
+            else:
+                track = path.normpath(path.join(rel_dir, line))
+
+            entry = self.dirs.get(path.dirname(track))
+            if entry is not None and path.basename(track) in entry['files'] and not is_playlist_file(track):
+                tracks.append(track)
+
+        return tracks
+
+    def snapshot(self):
+        """
+        Get tuple of (version, dictionary of tag payload -> relative file path,
+        dictionary of playlist tag payload -> (relative playlist path, list of relative file paths))
+        """
+        with self.lock:
+            return self.version, dict(self.files_by_hash), \
+                {payload: (rel_path, self.playlist_tracks[rel_path]) for payload, rel_path in self.playlists_by_hash.items()}
+
+    def iter_files(self, query='', match='substring', descending=False, cursor=None):
+        """
+        Iterate over (relative file path, tag payload) in case-insensitive order, optionally filtered.
+        query -- search string, matched case-insensitively against relative file paths
+        match -- 'prefix' or 'substring'
+        descending -- iterate in descending order
+        cursor -- relative file path to continue after
+        """
+        listing = self.listing
+        files = self.files
+        query = query.lower()
+
+        if descending:
+            end = len(listing)
+            if cursor is not None:
+                end = bisect.bisect_left(listing, (cursor.lower(), cursor))
+            if query and match == 'prefix':
+                end = min(end, bisect.bisect_left(listing, (query + '\uffff',)))
+            indices = range(end - 1, -1, -1)
+        else:
+            start = 0
+            if cursor is not None:
+                start = bisect.bisect_right(listing, (cursor.lower(), cursor))
+            if query and match == 'prefix':
+                start = max(start, bisect.bisect_left(listing, (query,)))
+            indices = range(start, len(listing))
+
+        for i in indices:
+            key, rel_path = listing[i]
+            if query:
+                if match == 'prefix':
+                    if not key.startswith(query):
+                        break
+                elif query not in key:
+                    continue
+            file_hash = files.get(rel_path)
+            if file_hash is not None:
+                yield rel_path, file_hash
+
+    def page(self, query='', match='substring', descending=False, cursor=None, limit=100):
+        """
+        Get one page of files, see iter_files(). Returns tuple of (list of (relative file path, tag payload),
+        cursor for next page or None if this was the last page).
+        """
+        items = []
+        for item in self.iter_files(query, match, descending, cursor):
+            if len(items) == limit:
+                return items, items[-1][0]
+            items.append(item)
+        return items, None
+
+    def count(self, query='', match='substring'):
+        """
+        Get number of files matching query, see iter_files(). Counts are cached until the index changes.
+        """
+        version, counts = self.counts
+        if version != self.version:
+            version, counts = self.counts = (self.version, dict())
+
+        key = (query.lower(), match)
+        n = counts.get(key)
+        if n is None:
+            n = sum(1 for _ in self.iter_files(query, match))
+            if len(counts) >= 1000:
+                counts.clear()
+            counts[key] = n
+        return n
+
+    def watch(self, interval):
+        """
+        Refresh index every interval seconds in a background thread
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("Error refreshing music library")
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+
+def sort_key(rel_path):
+    """
+    Key for sorting relative file paths case-insensitively, ties broken by case
+    """
+    return rel_path.lower(), rel_path
+
+
+def is_playlist_file(file_path):
+    return path.splitext(file_path)[1].lower() in PLAYLIST_EXTENSIONS
+
+
+def hash_file(file_path):
+    """
+    Get MD5 digest of file contents - runs in a ContentIds worker process
+    """
+    m = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            m.update(chunk)
+    return m.digest()
+
+
+def hash_files(file_paths):
+    """
+    Get MD5 digests of the contents of several files, None for files that can't be read - runs in a
+    ContentIds worker process
+    """
+    digests = []
+    for file_path in file_paths:
+        try:
+            digests.append(hash_file(file_path))
+        except OSError:
+            digests.append(None)
+    return digests
+
+
+def lower_priority():
+    """
+    ContentIds worker process initializer
+    """
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+
+class ContentIds(object):
+    """
+    Content-based tag payloads for music files, so that tags keep working when files are renamed or moved.
+
+    Files are checked in a background thread and hashed in batches in a background process pool; results
+    are cached by (inode, size, mtime), so that unchanged files are never read again, and persisted to disk. Tag payloads a file was known by before
+    (its name-based payload) are kept as aliases of its content-based payload.
+    """
+
+    def __init__(self, index_path, id_function, workers=1, batch_size=200):
+        """
+        index_path -- file to persist the index to
+        id_function -- function mapping a file content digest to its tag payload
+        workers -- number of hashing processes
+        batch_size -- number of files per hashing job, changes are reported after each job
+        """
+        self.index_path = index_path
+        self.id_function = id_function
+        self.workers = workers
+        self.batch_size = batch_size
+
+        # relative file path -> [inode, size, mtime, content payload hex]
+        self.entries = dict()
+
+        # payload hex -> content payload hex
+        self.aliases = dict()
+
+        # relative file paths currently being hashed
+        self.pending = set()
+
+        # latest (root, name hashes) passed to update(), checked by the update thread
+        self.request = None
+        self.requested = threading.Event()
+        self.thread = None
+
+        # called without arguments when new content payloads are known
+        self.on_change = None
+
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load index from disk
+        """
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read content id index {self.index_path}: {e}")
+            return
+
+        with self.lock:
+            self.entries = index.get('entries', dict())
+            self.aliases = index.get('aliases', dict())
+
+    def save(self):
+        """
+        Write index to disk
+        """
+        with self.lock:
+            index = dict(entries=dict(self.entries), aliases=dict(self.aliases))
+
+        try:
+            os.makedirs(path.dirname(self.index_path), exist_ok=True)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not write content id index {self.index_path}: {e}")
+
+    def lookup(self, rel_path):
+        """
+        Get content-based payload of file, None if not known (yet)
+        """
+        entry = self.entries.get(rel_path)
+        if entry is None:
+            return None
+        return binascii.a2b_hex(entry[3]).decode('latin-1')
+
+    def aliases_items(self):
+        """
+        Get list of (alias payload, content payload) tuples
+        """
+        with self.lock:
+            items = list(self.aliases.items())
+        return [(binascii.a2b_hex(k).decode('latin-1'), binascii.a2b_hex(v).decode('latin-1')) for k, v in items]
+
+    def update(self, root, name_hashes):
+        """
+        Schedule hashing of new and changed files, forget removed ones. Does not block: files are checked
+        in a background thread, only the latest call is acted upon.
+        root -- music root directory
+        name_hashes -- dictionary of relative file path -> name-based payload of all files
+        """
+        with self.lock:
+            self.request = (root, dict(name_hashes))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.update_loop, daemon=True)
+                self.thread.start()
+        self.requested.set()
+
+    def update_loop(self):
+        """
+        Check files for changes when requested by update() - runs in a background thread
+        """
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            with self.lock:
+                root, name_hashes = self.request
+
+            try:
+                self.check(root, name_hashes)
+            except Exception:
+                logger.exception("Error checking music file contents")
+
+    def check(self, root, name_hashes):
+        """
+        Stat all files, re-use known contents of renamed and moved files and submit the others for hashing,
+        batch_size files per job
+        """
+        to_hash = []
+        reused = False
+        with self.lock:
+            # contents by (inode, size, mtime), to recognize renamed and moved files
+            by_key = {tuple(entry[:3]): entry[3] for entry in self.entries.values()}
+
+            for rel_path in list(self.entries):
+                if rel_path not in name_hashes:
+                    del self.entries[rel_path]
+
+            pending = set(self.pending)
+
+        for rel_path, name_hash in name_hashes.items():
+            if rel_path in pending:
+                continue
+            try:
+                st = os.stat(path.join(root, rel_path))
+            except OSError:
+                continue
+            key = [st.st_ino, st.st_size, st.st_mtime]
+
+            with self.lock:
+                entry = self.entries.get(rel_path)
+                if entry is not None and entry[:3] == key:
+                    continue
+
+                content_hex = by_key.get(tuple(key))
+                if content_hex is not None:
+                    self.entries[rel_path] = key + [content_hex]
+                    self.aliases[binascii.b2a_hex(name_hash.encode('latin-1')).decode()] = content_hex
+                    reused = True
+                else:
+                    self.pending.add(rel_path)
+                    to_hash.append((rel_path, name_hash, key))
+
+        if reused:
+            self.save()
+            if self.on_change is not None:
+                self.on_change()
+
+        if not to_hash:
+            return
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=lower_priority)
+
+        logger.info(f"Hashing contents of {len(to_hash)} music files in the background")
+        for i in range(0, len(to_hash), self.batch_size):
+            batch = to_hash[i: i + self.batch_size]
+            future = self.pool.submit(hash_files, [path.join(root, rel_path) for rel_path, _, _ in batch])
+            future.add_done_callback(lambda f, batch=batch: self.hashed(f, batch))
+
+    def hashed(self, future, batch):
+        """
+        Store hashing results of a batch of (relative file path, name-based payload, stat key) - runs in a
+        result thread of the process pool
+        """
+        try:
+            digests = future.result()
+        except Exception as e:
+            logger.warning(f"Could not hash music files: {e}")
+            digests = [None] * len(batch)
+
+        report = False
+        with self.lock:
+            for (rel_path, name_hash, key), digest in zip(batch, digests):
+                self.pending.discard(rel_path)
+                if digest is None:
+                    logger.warning(f"Could not hash music file {rel_path}")
+                    continue
+
+                content_id = self.id_function(digest)
+                content_hex = binascii.b2a_hex(content_id.encode('latin-1')).decode()
+                self.entries[rel_path] = key + [content_hex]
+                self.aliases[binascii.b2a_hex(name_hash.encode('latin-1')).decode()] = content_hex
+                report = True
+
+        if report:
+            self.save()
+            if self.on_change is not None:
+                self.on_change()
@@ -0,0 +1,230 @@
+import bisect
+import ctypes
+import json
+import time
+from multiprocessing import Lock, RawArray, RawValue
+
+import settings
+
+"""
+
+Latency histograms and counters in shared memory.
+
+Metrics are registered at import time, before the RFID polling and playback engine processes are
+started, so that all processes update the same memory and the web server can report it. Timing uses
+time.monotonic(), which is comparable across processes.
+
+With metrics disabled (NFCMUSIK_METRICS=0), histogram() and counter() return shared no-op objects.
+
+"""
+
+# upper bounds of histogram buckets (seconds), plus one bucket for larger values
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram of durations in shared memory
+    """
+
+    def __init__(self, name, description, labels=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or dict()
+
+        # counts per bucket, last bucket for values above all bounds, and sum of values
+        self.counts = RawArray(ctypes.c_uint64, len(BUCKETS) + 1)
+        self.sum = RawValue(ctypes.c_double, 0.)
+
+        # several threads and processes may observe
+        self.lock = Lock()
+
+    @staticmethod
+    def time():
+        """
+        Get start time for observe_since()
+        """
+        return time.monotonic()
+
+    def observe_since(self, start):
+        """
+        Observe time passed since start (from time())
+        """
+        self.observe(time.monotonic() - start)
+
+    def observe(self, value):
+        """
+        Observe a duration (seconds)
+        """
+        index = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum.value += value
+
+    def snapshot(self):
+        """
+        Get tuple of (counts per bucket, sum)
+        """
+        with self.lock:
+            return list(self.counts), self.sum.value
+
+    @staticmethod
+    def quantile(counts, q):
+        """
+        Estimate quantile q (0-1) from bucket counts, interpolating linearly within buckets.
+        None if there are no observations.
+        """
+        total = sum(counts)
+        if total == 0:
+            return None
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count > 0 and seen + count >= rank:
+                lower = BUCKETS[index - 1] if index > 0 else 0.
+                if index == len(BUCKETS):
+                    return lower
+                return lower + (BUCKETS[index] - lower) * (rank - seen) / count
+            seen += count
+
+        return BUCKETS[-1]
+
+
+class Counter(object):
+    """
+    Counter in shared memory, for a single writer process
+    """
+
+    def __init__(self, name, description, labels=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or dict()
+        self.value = RawValue(ctypes.c_uint64, 0)
+
+    def inc(self, n=1):
+        self.value.value += n
+
+
+class NullHistogram(object):
+    """
+    Histogram that ignores all observations, used if metrics are disabled
+    """
+
+    @staticmethod
+    def time():
+        return 0.
+
+    def observe_since(self, start):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class NullCounter(object):
+    """
+    Counter that ignores all increments, used if metrics are disabled
+    """
+
+    def inc(self, n=1):
+        pass
+
+
+NULL_HISTOGRAM = NullHistogram()
+NULL_COUNTER = NullCounter()
+
+# registered metrics by (name, labels) - web endpoint histograms are registered on their first request,
+# while other requests may be reporting, so iterate over copies
+histograms = dict()
+counters = dict()
+
+
+def label_key(name, labels):
+    return name, tuple(sorted((labels or dict()).items()))
+
+
+def histogram(name, description, labels=None):
+    """
+    Get histogram, registering it if necessary
+    """
+    if not settings.METRICS:
+        return NULL_HISTOGRAM
+
+    key = label_key(name, labels)
+    if key not in histograms:
+        histograms[key] = Histogram(name, description, labels)
+    return histograms[key]
+
+
+def counter(name, description, labels=None):
+    """
+    Get counter, registering it if necessary
+    """
+    if not settings.METRICS:
+        return NULL_COUNTER
+
+    key = label_key(name, labels)
+    if key not in counters:
+        counters[key] = Counter(name, description, labels)
+    return counters[key]
+
+
+def report():
+    """
+    Get all metrics as dictionary: histograms with count, sum, p50, p99 and counts per bucket, and counters
+    """
+    out = dict(histograms=[], counters=[])
+
+    for h in list(histograms.values()):
+        counts, total = h.snapshot()
+        out['histograms'].append(dict(name=h.name,
+                                      labels=h.labels,
+                                      count=sum(counts),
+                                      sum=total,
+                                      p50=Histogram.quantile(counts, 0.5),
+                                      p99=Histogram.quantile(counts, 0.99),
+                                      buckets=[[bound, count] for bound, count in zip(list(BUCKETS) + ['+Inf'], counts)]))
+
+    for c in list(counters.values()):
+        out['counters'].append(dict(name=c.name, labels=c.labels, value=c.value.value))
+
+    return out
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}={json.dumps(str(v))}' for k, v in sorted(labels.items())) + '}'
+
+
+def prometheus_text():
+    """
+    Get all metrics in the Prometheus text exposition format
+    """
+    lines = []
+    described = set()
+
+    # samples of one metric name must be grouped
+    for h in sorted(list(histograms.values()), key=lambda h: h.name):
+        if h.name not in described:
+            described.add(h.name)
+            lines.append(f'# HELP {h.name} {h.description}')
+            lines.append(f'# TYPE {h.name} histogram')
+
+        counts, total = h.snapshot()
+        cumulative = 0
+        for bound, count in zip(list(BUCKETS) + ['+Inf'], counts):
+            cumulative += count
+            lines.append(f'{h.name}_bucket{format_labels(dict(h.labels, le=bound))} {cumulative}')
+        lines.append(f'{h.name}_sum{format_labels(h.labels)} {total}')
+        lines.append(f'{h.name}_count{format_labels(h.labels)} {cumulative}')
+
+    for c in sorted(list(counters.values()), key=lambda c: c.name):
+        if c.name not in described:
+            described.add(c.name)
+            lines.append(f'# HELP {c.name} {c.description}')
+            lines.append(f'# TYPE {c.name} counter')
+        lines.append(f'{c.name}{format_labels(c.labels)} {c.value.value}')
+
+    return '\n'.join(lines) + '\n'
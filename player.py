@@ -0,0 +1,581 @@
+import ctypes
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import Process, Queue, RawValue
+from os import path
+
+import pygame
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+
+Playback engine, owns the pygame mixer in a separate process so that loading and decoding
+music files never blocks tag polling.
+
+"""
+
+# pygame event posted by the mixer when a track ends
+MUSIC_END = pygame.USEREVENT + 1
+
+
+# latency metrics of the engine process
+METRIC_LOAD = metrics.histogram('nfcmusik_mixer_load_seconds', 'Duration of loading music files into the mixer')
+METRIC_PLAY = metrics.histogram('nfcmusik_mixer_play_seconds', 'Duration of starting playback in the mixer')
+METRIC_TAP_TO_SOUND = metrics.histogram('nfcmusik_tap_to_sound_seconds',
+                                        'Time from noticing a tag to playback started')
+
+# warm cache metrics: music files opened with and without cached head, and start latencies
+METRIC_CACHE_HITS = metrics.counter('nfcmusik_audio_cache_hits_total', 'Music files opened with cached head')
+METRIC_CACHE_MISSES = metrics.counter('nfcmusik_audio_cache_misses_total', 'Music files opened without cached head')
+METRIC_START_CACHED = metrics.histogram('nfcmusik_playback_start_seconds',
+                                        'Duration of starting playback of a music file', dict(cached='true'))
+METRIC_START_UNCACHED = metrics.histogram('nfcmusik_playback_start_seconds',
+                                          'Duration of starting playback of a music file', dict(cached='false'))
+
+
+class HeadCachedFile(io.RawIOBase):
+    """
+    Read-only file, serving the first bytes from memory and opening the file on disk only
+    when reading beyond them
+    """
+
+    def __init__(self, file_path, head):
+        super().__init__()
+        self.file_path = file_path
+        self.head = head
+        self.position = 0
+        self.file = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.disk_file().seek(offset, io.SEEK_END)
+        return self.position
+
+    def readinto(self, b):
+        if self.position < len(self.head):
+            n = min(len(b), len(self.head) - self.position)
+            b[:n] = self.head[self.position:self.position + n]
+        else:
+            f = self.disk_file()
+            f.seek(self.position)
+            n = f.readinto(b)
+        self.position += n
+        return n
+
+    def disk_file(self):
+        if self.file is None:
+            self.file = open(self.file_path, 'rb')
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        super().close()
+
+
+class WarmCache(object):
+    """
+    Keeps the head of recently and frequently played music files in memory, so that playback starts
+    without waiting for the SD card while the rest of the file streams from disk.
+
+    Heads are evicted least-recently-used first to stay within max_bytes. Play counts are persisted,
+    the most played files are prefetched when the engine starts. Hit/miss counters and start latencies
+    are kept in shared memory.
+    """
+
+    def __init__(self, max_bytes, head_bytes, prefetch_count, counts_path=None):
+        self.max_bytes = max_bytes
+        self.head_bytes = head_bytes
+        self.prefetch_count = prefetch_count
+        self.counts_path = counts_path
+
+        # file path -> head bytes, total size of heads
+        self.heads = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # file path -> number of plays
+        self.play_counts = dict()
+
+        # queue of files to prefetch, and prefetching thread
+        self.prefetch_queue = queue.Queue()
+        self.thread = None
+
+        # statistics, start latency sums in microseconds
+        self.hits = RawValue(ctypes.c_uint64, 0)
+        self.misses = RawValue(ctypes.c_uint64, 0)
+        self.hit_start_us = RawValue(ctypes.c_uint64, 0)
+        self.miss_start_us = RawValue(ctypes.c_uint64, 0)
+
+    def start(self):
+        """
+        Load play counts and start prefetching the most played files - call this from the engine process
+        """
+        if self.counts_path is not None:
+            try:
+                with open(self.counts_path) as f:
+                    self.play_counts = json.load(f)
+            except (OSError, ValueError):
+                self.play_counts = dict()
+
+        self.thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+        self.thread.start()
+
+        for file_path in sorted(self.play_counts, key=self.play_counts.get, reverse=True)[:self.prefetch_count]:
+            self.prefetch_queue.put(file_path)
+
+    def open(self, file_path):
+        """
+        Get file-like object for playing file_path, and whether its head was cached
+        """
+        with self.lock:
+            head = self.heads.get(file_path)
+            if head is not None:
+                self.heads.move_to_end(file_path)
+            self.play_counts[file_path] = self.play_counts.get(file_path, 0) + 1
+
+        self.prefetch_queue.put(None if head is not None else file_path)
+
+        if head is not None:
+            return HeadCachedFile(file_path, head), True
+        else:
+            return open(file_path, 'rb'), False
+
+    def prefetch(self, file_path):
+        """
+        Read head of file_path in the background, e.g. the next track of a playlist
+        """
+        self.prefetch_queue.put(file_path)
+
+    def record_use(self, cached):
+        """
+        Record whether the music was loaded from a cached head - the mixer may have loaded the file by
+        path instead, see load_file()
+        """
+        if cached:
+            self.hits.value += 1
+            METRIC_CACHE_HITS.inc()
+        else:
+            self.misses.value += 1
+            METRIC_CACHE_MISSES.inc()
+
+    def record_start(self, cached, seconds):
+        """
+        Record latency of starting playback
+        """
+        if cached:
+            self.hit_start_us.value += int(seconds * 1e6)
+            METRIC_START_CACHED.observe(seconds)
+        else:
+            self.miss_start_us.value += int(seconds * 1e6)
+            METRIC_START_UNCACHED.observe(seconds)
+
+    def prefetch_loop(self):
+        """
+        Read heads of queued files, save play counts - runs in a background thread
+        """
+        while True:
+            file_path = self.prefetch_queue.get()
+
+            # None: only save play counts
+            if file_path is not None:
+                self.load(file_path)
+            self.save_counts()
+
+    def load(self, file_path):
+        with self.lock:
+            if file_path in self.heads:
+                return
+
+        try:
+            with open(file_path, 'rb') as f:
+                head = f.read(self.head_bytes)
+        except OSError as e:
+            logger.debug(f"WarmCache: could not read {file_path}: {e}")
+            return
+
+        with self.lock:
+            self.heads[file_path] = head
+            self.size += len(head)
+            while self.size > self.max_bytes and len(self.heads) > 1:
+                _, evicted = self.heads.popitem(last=False)
+                self.size -= len(evicted)
+
+    def save_counts(self):
+        if self.counts_path is None:
+            return
+        try:
+            os.makedirs(path.dirname(self.counts_path), exist_ok=True)
+            # the engine counts plays while this runs in the prefetching thread
+            with self.lock:
+                play_counts = dict(self.play_counts)
+
+            tmp_path = self.counts_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(play_counts, f)
+            os.replace(tmp_path, self.counts_path)
+        except OSError as e:
+            logger.debug(f"WarmCache: could not save play counts: {e}")
+
+    def stats(self):
+        """
+        Get cache statistics as dictionary, average start latencies in milliseconds
+        """
+        hits = self.hits.value
+        misses = self.misses.value
+        return dict(hits=hits,
+                    misses=misses,
+                    hit_rate=hits / (hits + misses) if hits + misses > 0 else 0.,
+                    cached_start_ms=self.hit_start_us.value / hits / 1000. if hits > 0 else 0.,
+                    uncached_start_ms=self.miss_start_us.value / misses / 1000. if misses > 0 else 0.)
+
+
+class PlaybackEngine(object):
+    """
+    Playback engine process, controlled via a command queue.
+
+    Commands are coalesced: of all commands pending when the engine gets to them, only the latest
+    play/playlist/stop command is executed. State changes are reported back via a state queue, see
+    poll_state(). Volume is not set by the engine, see util.VolumeController.
+
+    Playlists are played gaplessly: while a track plays, the head of the next one is prefetched and the
+    track is handed to the mixer queue, which starts it when the current one ends. Track changes are
+    noticed through the mixer end event, which needs the (dummy) pygame video system - without it,
+    tracks are started one after the other when the mixer is idle.
+    """
+
+    def __init__(self, cache=None):
+        """
+        cache -- WarmCache for music file heads, None to always play from disk
+        """
+        self.cache = cache
+
+        # commands (name, argument) to the engine, state reports from the engine
+        self.commands = Queue()
+        self.states = Queue()
+
+        # engine process
+        self.process = None
+
+        # engine check interval (seconds) when no commands arrive, to detect end of playback
+        self.check_interval = 0.2
+
+        # delay (seconds) from starting a playlist track to queueing the next one, to prefetch its head
+        self.queue_delay = 0.5
+
+        # latest state reported by the engine - only valid in the process calling poll_state()
+        self.state = dict(status='stopped', file=None, time=0.)
+
+        # engine state - only valid in the engine process: whether mixer end events are available,
+        # file paths of the playlist (one entry for single files), index and path of the current track,
+        # file object the mixer streams from, time to queue the next track (None: not due) and
+        # queued track as (file path, file object)
+        self.end_events = False
+        self.tracks = []
+        self.position = 0
+        self.current = None
+        self.current_file = None
+        self.queue_time = None
+        self.queued = None
+
+    def start(self):
+        """
+        Start engine process
+        """
+        self.process = Process(target=self.run, daemon=True)
+        self.process.start()
+
+    def play(self, file_path, tag_time=None):
+        """
+        Play music file
+        tag_time -- time.monotonic() the tag requesting playback was noticed, for latency metrics
+        """
+        self.commands.put(('play', (file_path, tag_time)))
+
+    def play_playlist(self, file_paths, tag_time=None):
+        """
+        Play list of music files gaplessly, in order
+        tag_time -- time.monotonic() the tag requesting playback was noticed, for latency metrics
+        """
+        self.commands.put(('playlist', (list(file_paths), tag_time)))
+
+    def stop(self):
+        """
+        Stop playback
+        """
+        self.commands.put(('stop', None))
+
+    def shutdown(self):
+        """
+        Stop engine process
+        """
+        self.commands.put(('quit', None))
+
+    def poll_state(self):
+        """
+        Get latest state reported by the engine, as dictionary with keys status ('playing', 'stopped'
+        or 'finished'), file (file path, None if stopped) and time (time.monotonic() of the state change)
+        """
+        try:
+            while True:
+                self.state = self.states.get_nowait()
+        except queue.Empty:
+            pass
+        return self.state
+
+    def report(self, status, file_path):
+        self.states.put(dict(status=status, file=file_path, time=time.monotonic()))
+
+    def next_commands(self):
+        """
+        Wait for commands, return coalesced (transport command, quit flag)
+        """
+        try:
+            commands = [self.commands.get(timeout=self.check_interval)]
+        except queue.Empty:
+            return None, False
+
+        try:
+            while True:
+                commands.append(self.commands.get_nowait())
+        except queue.Empty:
+            pass
+
+        transport = None
+        do_quit = False
+        for command in commands:
+            if command[0] in ('play', 'playlist', 'stop'):
+                transport = command
+            elif command[0] == 'quit':
+                do_quit = True
+
+        return transport, do_quit
+
+    def run(self):
+        """
+        Engine main loop - runs in the engine process
+        """
+        pygame.mixer.init()
+        self.end_events = init_end_events()
+
+        if self.cache is not None:
+            self.cache.start()
+
+        while True:
+            transport, do_quit = self.next_commands()
+
+            if do_quit:
+                pygame.mixer.music.stop()
+                break
+
+            if transport is not None and transport[0] in ('play', 'playlist'):
+                tracks, tag_time = transport[1]
+                self.stop_tracks()
+                self.tracks = [tracks] if transport[0] == 'play' else tracks
+                self.start_track(0, tag_time)
+
+            elif transport is not None and transport[0] == 'stop':
+                if self.stop_tracks():
+                    self.report('stopped', None)
+
+            elif self.current is not None:
+                self.check_tracks()
+
+    def start_track(self, position, tag_time=None):
+        """
+        Play track at position in the playlist, or the next one that can be played
+        """
+        for position in range(position, len(self.tracks)):
+            file_path = self.tracks[position]
+            try:
+                start = time.monotonic()
+                if self.cache is not None:
+                    f, cached = self.cache.open(file_path)
+                    f = load_file(f, file_path)
+                    cached = cached and f is not None
+                    self.cache.record_use(cached)
+                else:
+                    f, cached = None, False
+                    pygame.mixer.music.load(file_path)
+                METRIC_LOAD.observe_since(start)
+
+                play_start = METRIC_PLAY.time()
+                pygame.mixer.music.play()
+                METRIC_PLAY.observe_since(play_start)
+                if tag_time is not None:
+                    METRIC_TAP_TO_SOUND.observe_since(tag_time)
+
+                if self.cache is not None:
+                    self.cache.record_start(cached, time.monotonic() - start)
+                    logger.debug("PlaybackEngine: started %s in %.1f ms, cached: %s, cache stats %s",
+                                 file_path, (time.monotonic() - start) * 1000., cached, self.cache.stats())
+
+                # end events of the previous track
+                if self.end_events:
+                    pygame.event.clear(MUSIC_END)
+
+                # keep file object alive while the mixer streams from it
+                if self.current_file is not None:
+                    self.current_file.close()
+                self.current_file = f
+
+                self.position = position
+                self.current = file_path
+                self.report('playing', file_path)
+                self.prepare_next()
+                return
+            except (pygame.error, OSError) as e:
+                logger.error(f"Could not play music file {file_path}: {e}")
+
+        self.tracks = []
+        self.current = None
+        self.report('stopped', None)
+
+    def prepare_next(self):
+        """
+        Start prefetching the next playlist track, it is queued after queue_delay
+        """
+        self.queue_time = None
+        if self.end_events and self.position + 1 < len(self.tracks):
+            self.queue_time = time.monotonic() + self.queue_delay
+            if self.cache is not None:
+                self.cache.prefetch(self.tracks[self.position + 1])
+
+    def queue_next(self):
+        """
+        Hand the next playlist track to the mixer queue
+        """
+        self.queue_time = None
+        file_path = self.tracks[self.position + 1]
+        try:
+            if self.cache is not None:
+                f, cached = self.cache.open(file_path)
+                f = queue_file(f, file_path)
+                self.cache.record_use(cached and f is not None)
+            else:
+                f = None
+                pygame.mixer.music.queue(file_path)
+            self.queued = (file_path, f)
+        except (pygame.error, OSError) as e:
+            # started without queue when the current track ends
+            logger.error(f"Could not queue music file {file_path}: {e}")
+
+    def check_tracks(self):
+        """
+        Queue the next playlist track when due, follow track changes and detect the end of playback
+        """
+        if self.queue_time is not None and time.monotonic() >= self.queue_time:
+            self.queue_next()
+
+        ended = len(pygame.event.get(MUSIC_END)) if self.end_events else 0
+        if ended == 0 and self.queued is None and not pygame.mixer.music.get_busy():
+            ended = 1
+
+        for _ in range(ended):
+            if self.queued is not None:
+                # the mixer started the queued track
+                file_path, f = self.queued
+                self.queued = None
+                if self.current_file is not None:
+                    self.current_file.close()
+                self.current_file = f
+                self.position += 1
+                self.current = file_path
+                self.report('playing', file_path)
+                self.prepare_next()
+
+            elif self.position + 1 < len(self.tracks):
+                self.start_track(self.position + 1)
+
+            else:
+                self.report('finished', self.current)
+                self.tracks = []
+                self.current = None
+                return
+
+    def stop_tracks(self):
+        """
+        Stop playback and drop queued tracks, returns True if a track was playing
+        """
+        pygame.mixer.music.stop()
+        if self.end_events:
+            pygame.event.clear(MUSIC_END)
+
+        if self.queued is not None:
+            if self.queued[1] is not None:
+                self.queued[1].close()
+            self.queued = None
+        self.queue_time = None
+
+        playing = self.current is not None
+        self.tracks = []
+        self.current = None
+        return playing
+
+
+def init_end_events():
+    """
+    Make the mixer post MUSIC_END events, returns False if pygame events are not available
+    """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    try:
+        pygame.display.init()
+    except pygame.error as e:
+        logger.warning(f"No pygame events, playlists are not gapless: {e}")
+        return False
+
+    pygame.mixer.music.set_endevent(MUSIC_END)
+    return True
+
+
+def load_file(f, file_path):
+    """
+    Load music from file object f, using the file name extension as type hint if pygame supports it.
+    If pygame cannot load from the file object (e.g. pygame 1.9 without type hints), f is closed and
+    the music is loaded from file_path. Returns f, or None if loaded from file_path.
+    """
+    return load_with(pygame.mixer.music.load, f, file_path)
+
+
+def queue_file(f, file_path):
+    """
+    Queue music from file object f to play after the current track, see load_file()
+    """
+    return load_with(pygame.mixer.music.queue, f, file_path)
+
+
+def load_with(load, f, file_path):
+    try:
+        try:
+            load(f, path.splitext(file_path)[1].lstrip('.'))
+        except TypeError:
+            load(f)
+        return f
+    except pygame.error as e:
+        logger.debug(f"Could not load {file_path} from file object, loading by name: {e}")
+        f.close()
+        load(file_path)
+        return None
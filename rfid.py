@@ -1,13 +1,50 @@
 # coding=utf-8
+import threading
+import time
 from typing import List
 
-import RPi.GPIO as GPIO
-import spidev
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+try:
+    import spidev
+except ImportError:
+    spidev = None
+
+
+def _crc_a_table():
+    """
+    Lookup table for ISO 14443-A CRC (reflected polynomial x^16 + x^12 + x^5 + 1)
+    """
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 0x01 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_A_TABLE = _crc_a_table()
+
+
+def crc_a(data):
+    """
+    Calculate ISO 14443-A CRC of data in software.
+    Returns [low byte, high byte], i.e. the byte order in which the CRC is transmitted.
+    """
+    crc = 0x6363
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_A_TABLE[(crc ^ byte) & 0xFF]
+    return [crc & 0xFF, crc >> 8]
 
 
 class RFID:
     pin_rst = 22
     pin_ce = 0
+    pin_irq = 0
 
     mode_idle = 0x00
     mode_auth = 0x0E
@@ -22,6 +59,8 @@ class RFID:
 
     act_read = 0x30
     act_write = 0xA0
+    act_ntag_write = 0xA2
+    act_fast_read = 0x3A
     act_increment = 0xC1
     act_decrement = 0xC0
     act_restore = 0xC2
@@ -31,19 +70,36 @@ class RFID:
     act_reqall = 0x52
     act_anticl = 0x93
     act_select = 0x93
+    act_anticl_cl2 = 0x95
+    act_select_cl2 = 0x95
     act_end = 0x50
 
+    # first byte of the cascade level 1 UID of tags with double-size (7 byte) UIDs
+    cascade_tag = 0x88
+
+    # SAK bit set while the UID is not complete at the selected cascade level
+    sak_uid_incomplete = 0x04
+
     length = 16
 
+    # FIFO size - maximum response length
+    fifo_length = 64
+
     # See §9 of https://www.nxp.com/docs/en/data-sheet/MFRC522.pdf for an overview over and
     # explanation of all registers.
     CommandReg = 0x01
     ComlEnReg = 0x02
+    ComIrqReg = 0x04
+    ErrorReg = 0x06
     FIFODataReg = 0x09
+    FIFOLevelReg = 0x0A
+    ControlReg = 0x0C
     BitFramingReg = 0x0D
     ModeReg = 0x11
     TxControlReg = 0x14
     TxAutoReg = 0x15
+    CRCResultRegM = 0x21
+    CRCResultRegL = 0x22
     TModeReg = 0x2A
     TPrescalerReg = 0x2B
     TReloadRegH = 0x2C
@@ -51,22 +107,69 @@ class RFID:
 
     authed = False
 
-    def __init__(self, bus=0, device=0, speed=1000000, pin_rst=22, pin_ce=0):
+    # registers whose contents only the host changes - their values can be shadowed
+    shadow_registers = frozenset([0x02, 0x03, 0x0D, 0x11, 0x12, 0x13, 0x14, 0x15, 0x2A, 0x2B, 0x2C, 0x2D])
+
+    # registers with write-strobe semantics (ComIrqReg: Set1 bit, FIFOLevelReg: FlushBuffer bit), and the
+    # value to assume for read-modify-write: writing it back has the same effect as writing back the
+    # actual register contents
+    strobe_registers = {0x04: 0x7F, 0x0A: 0x00}
+
+    def __init__(self, bus=0, device=0, speed=1000000, pin_rst=22, pin_ce=0, pin_irq=0, spi=None, gpio=None,
+                 hw_crc=False, shadow=False, timeout_us=25000, sleep_us=300):
+        """
+        pin_irq -- GPIO pin (board numbering) connected to the MFRC522 IRQ pin, 0 if not connected
+        spi -- SpiDev-like object to use instead of spidev.SpiDev() (e.g. rfid_sim.FakeSpiDev)
+        gpio -- RPi.GPIO-like module to use instead of RPi.GPIO (e.g. rfid_sim.FakeGPIO)
+        hw_crc -- calculate CRCs on the MFRC522 coprocessor instead of in software
+        shadow -- keep a shadow copy of host-owned registers to skip reads in read-modify-write updates
+        timeout_us -- deadline for command completion in microseconds; the MFRC522 timer configured below
+                      fires after 15 ms, the deadline only guards against a hung chip or bus
+        sleep_us -- sleep between IRQ register checks while waiting for command completion (0: poll continuously);
+                    an empty request waits for the whole 15 ms timer window, which costs an empty poll about
+                    170 SPI transactions with continuous polling and about 50 with 300 us, at up to one sleep
+                    of added latency
+        """
         self.pin_rst = pin_rst
         self.pin_ce = pin_ce
+        self.pin_irq = pin_irq
+        self.hw_crc = hw_crc
+
+        # set on falling edge of the IRQ pin
+        self.irq_event = threading.Event()
+
+        # number of SPI transactions issued by this instance
+        self.transactions = 0
 
-        self.spi = spidev.SpiDev()
+        # register shadow cache (None if disabled) and number of SPI reads it saved
+        self.shadow = dict() if shadow else None
+        self.reads_saved = 0
+
+        # command completion deadline and wait statistics
+        self.timeout_us = timeout_us
+        self.sleep_us = sleep_us
+        self.timeouts = 0
+        self.last_wait_us = 0
+
+        self.gpio = gpio if gpio is not None else GPIO
+
+        self.spi = spi if spi is not None else spidev.SpiDev()
         self.spi.open(bus=bus, device=device)
         self.spi.max_speed_hz = speed
 
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(pin_rst, GPIO.OUT)
-        GPIO.output(pin_rst, 1)
+        self.gpio.setmode(self.gpio.BOARD)
+        self.gpio.setup(pin_rst, self.gpio.OUT)
+        self.gpio.output(pin_rst, 1)
         if pin_ce != 0:
-            GPIO.setup(pin_ce, GPIO.OUT)
-            GPIO.output(pin_ce, 1)
+            self.gpio.setup(pin_ce, self.gpio.OUT)
+            self.gpio.output(pin_ce, 1)
+        if pin_irq != 0:
+            # IRQ pin is open drain by default, active low with IRqInv set
+            self.gpio.setup(pin_irq, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+            self.gpio.add_event_detect(pin_irq, self.gpio.FALLING, callback=self.on_irq)
 
         self.reset()
+        # timer: prescaler 0xD3E (0.5 ms per tick), reload 30 - times out after 15 ms without answer
         self.dev_write(self.TModeReg, 0x8D)
         self.dev_write(self.TPrescalerReg, 0x3E)
         self.dev_write(self.TReloadRegL, 30)
@@ -76,36 +179,122 @@ class RFID:
         self.set_antenna(True)
 
     def spi_transfer(self, address: int, *data: int) -> List[int]:
+        self.transactions += 1
         if self.pin_ce != 0:
-            GPIO.output(self.pin_ce, 0)
+            self.gpio.output(self.pin_ce, 0)
         ret = self.spi.xfer2([address] + list(data))
         if self.pin_ce != 0:
-            GPIO.output(self.pin_ce, 1)
+            self.gpio.output(self.pin_ce, 1)
         return ret
 
     def dev_write(self, address, value):
         self.spi_transfer((address << 1) & 0x7E, value)
+        if self.shadow is not None and address in self.shadow_registers:
+            self.shadow[address] = value
 
     def dev_read(self, address):
-        return self.spi_transfer(((address << 1) & 0x7E) | 0x80, 0)[1]
+        value = self.spi_transfer(((address << 1) & 0x7E) | 0x80, 0)[1]
+        if self.shadow is not None and address in self.shadow_registers:
+            self.shadow[address] = value
+        return value
+
+    def dev_read_cached(self, address):
+        """
+        Read register for a read-modify-write update, from the shadow cache if possible
+        """
+        if self.shadow is not None:
+            if address in self.shadow:
+                self.reads_saved += 1
+                return self.shadow[address]
+            if address in self.strobe_registers:
+                self.reads_saved += 1
+                return self.strobe_registers[address]
+        return self.dev_read(address)
+
+    def invalidate_shadow(self):
+        """
+        Forget all shadowed register values
+        """
+        if self.shadow is not None:
+            self.shadow.clear()
+
+    def dev_write_burst(self, address, values):
+        """
+        Write several values to one register (e.g. the FIFO) in a single SPI transaction
+        """
+        if values:
+            self.spi_transfer((address << 1) & 0x7E, *values)
+
+    def dev_read_many(self, *addresses):
+        """
+        Read several registers in a single SPI transaction, using the MFRC522 multi-byte
+        read sequence: each byte sent carries the next address, the last one is 0.
+        """
+        if not addresses:
+            return []
+        addr = [((address << 1) & 0x7E) | 0x80 for address in addresses]
+        return self.spi_transfer(addr[0], *(addr[1:] + [0]))[1:]
+
+    def fifo_write(self, data):
+        """
+        Write data to the FIFO in a single SPI transaction
+        """
+        self.dev_write_burst(self.FIFODataReg, data)
+
+    def fifo_read(self, count):
+        """
+        Read count bytes from the FIFO in a single SPI transaction
+        """
+        return self.dev_read_many(*([self.FIFODataReg] * count))
 
     def set_bitmask(self, address, mask):
-        current = self.dev_read(address)
+        current = self.dev_read_cached(address)
         self.dev_write(address, current | mask)
 
     def clear_bitmask(self, address, mask):
-        current = self.dev_read(address)
+        current = self.dev_read_cached(address)
         self.dev_write(address, current & (~mask))
 
     def set_antenna(self, state):
         if state:
-            current = self.dev_read(self.TxControlReg)
-            if ~(current & 0x03):
-                self.set_bitmask(self.TxControlReg, 0x03)
+            current = self.dev_read_cached(self.TxControlReg)
+            if (current & 0x03) != 0x03:
+                self.dev_write(self.TxControlReg, current | 0x03)
         else:
             self.clear_bitmask(self.TxControlReg, 0x03)
 
-    def card_write(self, command, data):
+    def wait_irq(self, irq_wait, timeout_us=None):
+        """
+        Wait for completion of the current command: any of the irq_wait bits or the timer IRQ
+        (no answer within the time configured in the MFRC522 timer registers) set in ComIrqReg.
+        timeout_us -- deadline in microseconds, defaults to self.timeout_us
+        Returns the ComIrqReg value, or None if the deadline passed before any of the IRQs were raised.
+        """
+        if timeout_us is None:
+            timeout_us = self.timeout_us
+
+        start = time.monotonic()
+        deadline = start + timeout_us * 1e-6
+        while True:
+            n = self.dev_read(self.ComIrqReg)
+            now = time.monotonic()
+            if n & (irq_wait | 0x01):
+                break
+            if now >= deadline:
+                n = None
+                self.timeouts += 1
+                break
+            if self.sleep_us > 0:
+                time.sleep(self.sleep_us * 1e-6)
+
+        self.last_wait_us = int((now - start) * 1e6)
+        return n
+
+    def card_write(self, command, data, max_length=None):
+        """
+        Execute command with data, return (error state, response data, response length in bits).
+        max_length -- maximum number of response bytes to read, defaults to self.length
+        """
         back_data = []
         back_length = 0
         error = False
@@ -120,37 +309,34 @@ class RFID:
             irq_wait = 0x30
 
         self.dev_write(self.ComlEnReg, irq | 0x80)
-        self.clear_bitmask(0x04, 0x80)
-        self.set_bitmask(0x0A, 0x80)
+        self.clear_bitmask(self.ComIrqReg, 0x80)
+        self.set_bitmask(self.FIFOLevelReg, 0x80)
         self.dev_write(self.CommandReg, self.mode_idle)
 
-        for i in range(len(data)):
-            self.dev_write(self.FIFODataReg, data[i])
+        self.fifo_write(data)
 
         self.dev_write(self.CommandReg, command)
 
         if command == self.mode_transrec:
             self.set_bitmask(0x0D, 0x80)
 
-        i = 2000
-        while True:
-            n = self.dev_read(0x04)
-            i -= 1
-            if ~((i != 0) and ~(n & 0x01) and ~(n & irq_wait)):
-                break
+        n = self.wait_irq(irq_wait)
 
         self.clear_bitmask(0x0D, 0x80)
 
-        if i != 0:
-            if (self.dev_read(0x06) & 0x1B) == 0x00:
+        if n is not None:
+            # error, FIFO level and control register in one transaction
+            error_reg, fifo_level, control = self.dev_read_many(self.ErrorReg, self.FIFOLevelReg, self.ControlReg)
+
+            if (error_reg & 0x1B) == 0x00:
                 error = False
 
                 if n & irq & 0x01:
                     error = True
 
                 if command == self.mode_transrec:
-                    n = self.dev_read(0x0A)
-                    last_bits = self.dev_read(0x0C) & 0x07
+                    n = fifo_level
+                    last_bits = control & 0x07
                     if last_bits != 0:
                         back_length = (n - 1) * 8 + last_bits
                     else:
@@ -159,13 +345,18 @@ class RFID:
                     if n == 0:
                         n = 1
 
-                    if n > self.length:
-                        n = self.length
+                    if max_length is None:
+                        max_length = self.length
+                    if n > max_length:
+                        n = max_length
 
-                    for i in range(n):
-                        back_data.append(self.dev_read(self.FIFODataReg))
+                    back_data = self.fifo_read(n)
             else:
                 error = True
+                self.invalidate_shadow()
+        else:
+            error = True
+            self.invalidate_shadow()
 
         return error, back_data, back_length
 
@@ -182,9 +373,65 @@ class RFID:
 
         return False, back_bits
 
-    def anticoll(self):
+    def on_irq(self, channel):
+        self.irq_event.set()
+
+    def arm_tag_irq(self, req_mode=0x26):
+        """
+        Send a request for tag without waiting for the answer, with the receive IRQ routed to the IRQ pin.
+        The IRQ pin goes low as soon as a tag answers, see wait_tag_irq(). A tag that is already in the
+        field when arming only answers if it is IDLE, so switch the antenna off and on before, if necessary.
+        """
+        self.irq_event.clear()
+
+        # IRqInv | RxIEn: IRQ pin low on receive
+        self.dev_write(self.ComlEnReg, 0xA0)
+        self.clear_bitmask(self.ComIrqReg, 0x80)
+        self.set_bitmask(self.FIFOLevelReg, 0x80)
+        self.dev_write(self.CommandReg, self.mode_idle)
+
+        self.dev_write(self.BitFramingReg, 0x07)
+        self.fifo_write([req_mode])
+        self.dev_write(self.CommandReg, self.mode_transrec)
+        self.set_bitmask(self.BitFramingReg, 0x80)
+
+    def wait_tag_irq(self, timeout):
+        """
+        Block until the IRQ pin signals an answer to the request sent by arm_tag_irq(), or timeout (seconds)
+        passes. Returns True if the IRQ pin fired.
+        """
+        if self.pin_irq == 0:
+            raise RuntimeError("No IRQ pin configured")
+
+        # answer may have arrived before the edge detection callback was run
+        if self.gpio.input(self.pin_irq) == 0:
+            return True
+
+        return self.irq_event.wait(timeout)
+
+    def check_tag_irq(self):
+        """
+        Check the answer to the request sent by arm_tag_irq() and stop the command.
+        Returns (False, tag type) if a tag answered - the tag is READY, continue with anticoll() -
+        otherwise (True, None), like request().
+        """
+        n, error_reg, fifo_level, control = self.dev_read_many(
+            self.ComIrqReg, self.ErrorReg, self.FIFOLevelReg, self.ControlReg)
+
+        self.clear_bitmask(self.BitFramingReg, 0x80)
+        self.dev_write(self.CommandReg, self.mode_idle)
+        self.dev_write(self.ComlEnReg, 0x80)
+        self.clear_bitmask(self.ComIrqReg, 0x80)
+
+        if not (n & 0x20) or (error_reg & 0x1B) or fifo_level != 2 or (control & 0x07) != 0:
+            return True, None
+
+        return False, 0x10
+
+    def anticoll(self, cascade_level=act_anticl):
         """
         Anti-collision detection.
+        cascade_level -- anticollision command of the cascade level, act_anticl or act_anticl_cl2
         Returns tuple of (error state, tag ID).
         """
         serial_number = []
@@ -192,7 +439,7 @@ class RFID:
         serial_number_check = 0
 
         self.dev_write(self.BitFramingReg, 0x00)
-        serial_number.append(self.act_anticl)
+        serial_number.append(cascade_level)
         serial_number.append(0x20)
 
         (error, back_data, back_bits) = self.card_write(self.mode_transrec, serial_number)
@@ -208,12 +455,51 @@ class RFID:
 
         return error, back_data
 
+    def anticoll_full(self, uid):
+        """
+        Get the complete UID of the tag that answered anticoll() with uid and select it, so that it accepts
+        memory commands (READ, FAST_READ, WRITE). Double-size UIDs (NTAG21x) are completed by selecting
+        the tag at cascade level 1 and running anticollision and select at cascade level 2.
+        Returns tuple of (error state, UID as list of 4 or 7 byte values).
+        """
+        error, sak = self.select(uid)
+        if error:
+            return True, None
+
+        if uid[0] != self.cascade_tag:
+            if sak & self.sak_uid_incomplete:
+                return True, None
+            return False, list(uid[:4])
+
+        if not sak & self.sak_uid_incomplete:
+            return True, None
+
+        error, back_data = self.anticoll(self.act_anticl_cl2)
+        if error:
+            return True, None
+
+        error, sak = self.select(back_data, self.act_select_cl2)
+        if error or sak & self.sak_uid_incomplete:
+            return True, None
+
+        return False, list(uid[1:4]) + back_data[:4]
+
     def calculate_crc(self, data):
+        """
+        Calculate CRC_A of data, returns [low byte, high byte]
+        """
+        if self.hw_crc:
+            return self.calculate_crc_hw(data)
+        return crc_a(data)
+
+    def calculate_crc_hw(self, data):
+        """
+        Calculate CRC_A of data using the MFRC522 CRC coprocessor
+        """
         self.clear_bitmask(0x05, 0x04)
         self.set_bitmask(0x0A, 0x80)
 
-        for i in range(len(data)):
-            self.dev_write(self.FIFODataReg, data[i])
+        self.fifo_write(data)
         self.dev_write(self.CommandReg, self.mode_crc)
 
         i = 255
@@ -223,7 +509,7 @@ class RFID:
             if not ((i != 0) and not (n & 0x04)):
                 break
 
-        ret_data = [self.dev_read(0x22), self.dev_read(0x21)]
+        ret_data = self.dev_read_many(self.CRCResultRegL, self.CRCResultRegM)
 
         return ret_data
 
@@ -233,7 +519,16 @@ class RFID:
         uid -- list or tuple with four bytes tag ID
         Returns error state.
         """
-        buf = [self.act_select, 0x70] + [uid[i] for i in range(5)]
+        return self.select(uid)[0]
+
+    def select(self, uid, cascade_level=act_select):
+        """
+        Select tag at one cascade level.
+        uid -- UID bytes of the cascade level and check byte, as returned by anticoll()
+        cascade_level -- select command of the cascade level, act_select or act_select_cl2
+        Returns tuple of (error state, SAK).
+        """
+        buf = [cascade_level, 0x70] + [uid[i] for i in range(5)]
 
         crc = self.calculate_crc(buf)
         buf.append(crc[0])
@@ -242,9 +537,9 @@ class RFID:
         (error, back_data, back_length) = self.card_write(self.mode_transrec, buf)
 
         if (not error) and (back_length == 0x18):
-            return False
+            return False, back_data[0]
         else:
-            return True
+            return True, None
 
     def card_auth(self, auth_mode, block_address, key, uid):
         """
@@ -296,6 +591,26 @@ class RFID:
 
         return error, back_data
 
+    def fast_read(self, start_page, end_page):
+        """
+        Reads pages start_page to end_page (inclusive) of an NTAG21x tag in one command, at most 15 pages.
+        Returns tuple of (error state, read data).
+        """
+        length = (end_page - start_page + 1) * 4
+        if length <= 0 or length + 2 > self.fifo_length:
+            raise ValueError(f"Can read 1 to 15 pages at once, got {start_page} to {end_page}")
+
+        buf = [self.act_fast_read, start_page, end_page]
+        crc = self.calculate_crc(buf)
+        buf.append(crc[0])
+        buf.append(crc[1])
+        (error, back_data, back_length) = self.card_write(self.mode_transrec, buf, max_length=length)
+
+        if len(back_data) != length:
+            error = True
+
+        return error, back_data
+
     def write(self, block_address, data):
         """
         Writes data to block. You should be authenticated before calling write.
@@ -324,8 +639,25 @@ class RFID:
 
         return error
 
+    def ntag_write(self, page, data):
+        """
+        Writes 4 bytes of data to page of an NTAG21x tag, using the native single-frame WRITE command.
+        Returns error state.
+        """
+        buf = [self.act_ntag_write, page] + [data[i] for i in range(4)]
+        crc = self.calculate_crc(buf)
+        buf.append(crc[0])
+        buf.append(crc[1])
+
+        error, back_data, back_length = self.card_write(self.mode_transrec, buf)
+        if back_length != 4 or (back_data[0] & 0x0F) != 0x0A:
+            error = True
+
+        return error
+
     def reset(self):
         self.dev_write(self.CommandReg, self.mode_reset)
+        self.invalidate_shadow()
 
     def cleanup(self):
         """
@@ -333,5 +665,134 @@ class RFID:
         """
         if self.authed:
             self.stop_crypto()
-        GPIO.cleanup()
+        self.gpio.cleanup()
         self.spi.close()
+
+
+class RFIDSession:
+    """
+    Long-lived reader session.
+
+    Keeps one RFID instance open across poll cycles instead of re-opening SPI, re-configuring GPIO
+    and re-initialising the MFRC522 every time. The reader is only set up again after
+    max_errors consecutive errors, after the watchdog timeout (seconds without a successful
+    tag transaction) or after invalidate() was called.
+
+    field_settle -- seconds to wait after switching on the RF field, before tags are addressed
+    """
+
+    def __init__(self, max_errors=5, watchdog=300.0, field_settle=0.005, **rfid_kwargs):
+        self.max_errors = max_errors
+        self.watchdog = watchdog
+        self.field_settle = field_settle
+        self.rfid_kwargs = rfid_kwargs
+
+        # is the RF field known to be on and settled?
+        self.field_on = False
+
+        # current RFID instance, None if not set up
+        self.reader = None
+
+        # number of consecutive errors
+        self.errors = 0
+
+        # number of reader setups
+        self.setups = 0
+
+        # SPI transactions and shadow cache savings of readers that have been closed already
+        self.closed_transactions = 0
+        self.closed_reads_saved = 0
+
+        # time of last setup or successful transaction
+        self.last_ok = 0.
+
+    def open(self):
+        """
+        Get the reader, setting it up if there is none or if it needs re-initialisation
+        """
+        if self.reader is not None and (
+                self.errors >= self.max_errors or time.monotonic() - self.last_ok > self.watchdog):
+            self.close()
+
+        if self.reader is None:
+            self.reader = RFID(**self.rfid_kwargs)
+            self.field_on = False
+            self.setups += 1
+            self.errors = 0
+            self.last_ok = time.monotonic()
+
+        return self.reader
+
+    def begin_cycle(self):
+        """
+        Get the reader and switch on the RF field for one poll cycle
+        """
+        rdr = self.open()
+        if not self.field_on:
+            rdr.set_antenna(True)
+            time.sleep(self.field_settle)
+            self.field_on = True
+        return rdr
+
+    def end_cycle(self):
+        """
+        Switch off the RF field after a poll cycle. A tag left on the reader loses power and
+        returns to IDLE, so that it answers the next request() like a freshly placed tag.
+        """
+        if self.reader is not None:
+            self.reader.set_antenna(False)
+        self.field_on = False
+
+    def ok(self):
+        """
+        Record a successful tag transaction
+        """
+        self.errors = 0
+        self.last_ok = time.monotonic()
+
+    def error(self):
+        """
+        Record a failed tag transaction
+        """
+        self.errors += 1
+
+    def invalidate(self):
+        """
+        Force re-initialisation on next open()
+        """
+        self.close()
+
+    def close(self):
+        """
+        Clean up the reader, if any
+        """
+        if self.reader is not None:
+            self.closed_transactions += self.reader.transactions
+            self.closed_reads_saved += self.reader.reads_saved
+            self.reader.cleanup()
+            self.reader = None
+
+    @property
+    def transactions(self):
+        """
+        Total number of SPI transactions issued in this session
+        """
+        return self.closed_transactions + (self.reader.transactions if self.reader is not None else 0)
+
+    @property
+    def reads_saved(self):
+        """
+        Total number of SPI reads saved by the register shadow cache in this session
+        """
+        return self.closed_reads_saved + (self.reader.reads_saved if self.reader is not None else 0)
+
+    def stats(self):
+        """
+        Get session statistics as dictionary
+        """
+        return dict(setups=self.setups,
+                    transactions=self.transactions,
+                    reads_saved=self.reads_saved,
+                    errors=self.errors,
+                    timeouts=self.reader.timeouts if self.reader is not None else 0,
+                    last_wait_us=self.reader.last_wait_us if self.reader is not None else 0)
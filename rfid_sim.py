@@ -0,0 +1,653 @@
+"""
+
+Fake SPI and GPIO backends for running rfid.RFID without a Raspberry Pi.
+
+FakeSpiDev is a plain register file that no tag ever answers. SimulatedMFRC522 models the reader
+at register level (FIFO, IRQ and error registers, timer, CRC coprocessor, IRQ pin) with virtual
+NTAG213 tags that can be put on and taken off the reader on a schedule.
+
+Usage:
+
+    from rfid import RFID
+    from rfid_sim import FakeGPIO, NTAG213, SimulatedMFRC522
+
+    gpio = FakeGPIO()
+    sim = SimulatedMFRC522(gpio=gpio, pin_irq=18)
+    sim.add_tag(NTAG213(), delay=0.5, duration=2.)
+
+    rdr = RFID(spi=sim, gpio=gpio, pin_irq=18)
+
+"""
+
+import random
+import threading
+import time
+
+from rfid import crc_a
+
+
+class FakeSpiDev(object):
+    """
+    Stand-in for spidev.SpiDev, backed by a plain MFRC522 register file.
+
+    No tag ever answers: starting a Transceive command immediately raises the timer IRQ.
+    """
+
+    # registers and bits the fake reacts to
+    CommandReg = 0x01
+    ComIrqReg = 0x04
+    DivIrqReg = 0x05
+
+    mode_transrec = 0x0C
+    mode_reset = 0x0F
+    mode_crc = 0x03
+
+    def __init__(self):
+        self.registers = [0] * 64
+        self.is_open = False
+        self.max_speed_hz = 0
+
+        # number of xfer2 calls and opens
+        self.transfers = 0
+        self.opens = 0
+
+    def open(self, bus=0, device=0):
+        self.is_open = True
+        self.opens += 1
+
+    def close(self):
+        self.is_open = False
+
+    def xfer2(self, data):
+        self.transfers += 1
+
+        address = (data[0] >> 1) & 0x3F
+        if data[0] & 0x80:
+            return [0] + [self.registers[address]] * (len(data) - 1)
+
+        for value in data[1:]:
+            self.write_register(address, value)
+        return [0] * len(data)
+
+    def write_register(self, address, value):
+        if address in (self.ComIrqReg, self.DivIrqReg):
+            # bit 7 selects whether the marked bits are set or cleared
+            if value & 0x80:
+                self.registers[address] |= value & 0x7F
+            else:
+                self.registers[address] &= ~value & 0x7F
+            return
+
+        self.registers[address] = value
+
+        if address == self.CommandReg:
+            command = value & 0x0F
+            if command == self.mode_reset:
+                self.registers = [0] * 64
+            elif command == self.mode_transrec:
+                self.registers[self.ComIrqReg] |= 0x01
+            elif command == self.mode_crc:
+                self.registers[self.DivIrqReg] |= 0x04
+
+
+class FakeGPIO(object):
+    """
+    Stand-in for the RPi.GPIO module.
+
+    Edges on input pins can be simulated with set_input(), e.g. from another thread or a timer,
+    to drive code waiting in wait_for_edge() or registered with add_event_detect().
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.pins = dict()
+
+        # edge detection: channel -> (edge, list of callbacks)
+        self.event_detect = dict()
+
+        # notified on every input change
+        self.edge_condition = threading.Condition()
+
+        # number of setup() and cleanup() calls, and of simulated edges
+        self.setups = 0
+        self.cleanups = 0
+        self.edges = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        self.setups += 1
+        self.pins[channel] = 1 if pull_up_down == self.PUD_UP else 0
+        if initial is not None:
+            self.pins[channel] = initial
+
+    def output(self, channel, value):
+        self.pins[channel] = value
+
+    def input(self, channel):
+        return self.pins.get(channel, 0)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        self.event_detect[channel] = (edge, [callback] if callback is not None else [])
+
+    def remove_event_detect(self, channel):
+        self.event_detect.pop(channel, None)
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """
+        timeout in milliseconds, like RPi.GPIO; returns channel, or None on timeout
+        """
+        with self.edge_condition:
+            level = self.pins.get(channel, 0)
+            changed = self.edge_condition.wait_for(lambda: self.matches(edge, level, self.pins.get(channel, 0)),
+                                                   None if timeout is None else timeout / 1000.)
+        return channel if changed else None
+
+    def set_input(self, channel, value):
+        """
+        Simulate a level change on an input pin, fires edge detection callbacks
+        """
+        with self.edge_condition:
+            level = self.pins.get(channel, 0)
+            self.pins[channel] = value
+            self.edge_condition.notify_all()
+
+        if level != value:
+            self.edges += 1
+            edge, callbacks = self.event_detect.get(channel, (None, []))
+            if self.matches(edge, level, value):
+                for callback in callbacks:
+                    callback(channel)
+
+    def matches(self, edge, before, after):
+        if before == after:
+            return False
+        if edge == self.RISING:
+            return after == 1
+        if edge == self.FALLING:
+            return after == 0
+        return edge == self.BOTH
+
+    def cleanup(self):
+        self.cleanups += 1
+        self.pins = dict()
+        self.event_detect = dict()
+
+
+class NTAG213(object):
+    """
+    Virtual NXP NTAG213 tag: 7-byte UID, 45 pages of 4 bytes (user memory: pages 4 to 39).
+
+    Supports REQA/WUPA, anticollision and select for both cascade levels, READ, FAST_READ, WRITE,
+    COMPATIBILITY_WRITE and HALT. Like real tags, memory commands are only accepted once the tag is selected
+    at cascade level 2 (ACTIVE state), other frames send the tag back to IDLE without an answer.
+    """
+
+    # tag states
+    IDLE = 0
+    READY1 = 1
+    READY2 = 2
+    ACTIVE = 3
+    HALT = 4
+
+    N_PAGES = 45
+    FIRST_USER_PAGE = 4
+
+    ATQA = [0x44, 0x00]
+    ACK = 0x0A
+    NAK_ARGUMENT = 0x00
+    NAK_CRC = 0x01
+
+    # time to program one page (seconds)
+    write_time = 0.0041
+
+    def __init__(self, uid=None, pages=None):
+        """
+        uid -- list of 7 byte values, random NXP UID if None
+        pages -- dictionary of page number -> list of 4 byte values to store in user memory
+        """
+        if uid is None:
+            uid = [0x04] + [random.randrange(256) for _ in range(6)]
+        self.uid = list(uid)
+
+        # memory: UID and check bytes, capability container, zeroed user memory
+        bcc0 = 0x88 ^ self.uid[0] ^ self.uid[1] ^ self.uid[2]
+        bcc1 = self.uid[3] ^ self.uid[4] ^ self.uid[5] ^ self.uid[6]
+        self.memory = self.uid[:3] + [bcc0] + self.uid[3:] + [bcc1, 0x48, 0x00, 0x00] + [0xE1, 0x10, 0x12, 0x00]
+        self.memory += [0] * (self.N_PAGES * 4 - len(self.memory))
+        for page, data in (pages or dict()).items():
+            self.memory[page * 4: page * 4 + 4] = list(data)
+
+        self.state = self.IDLE
+
+        # page to write with the second part of a COMPATIBILITY_WRITE, None if none pending
+        self.compat_write_page = None
+
+        # number of commands handled and pages written
+        self.commands = 0
+        self.writes = 0
+
+    def power_off(self):
+        """
+        Tag left the RF field or the field was switched off
+        """
+        self.state = self.IDLE
+        self.compat_write_page = None
+
+    def page_data(self, start_page, end_page):
+        """
+        Get memory contents of pages start_page to end_page (inclusive) as list of byte values
+        """
+        return self.memory[start_page * 4: end_page * 4 + 4]
+
+    def receive(self, frame, bits):
+        """
+        Handle frame (list of byte values, bits in the last byte: 7 for short frames, else 8) sent by the reader.
+        Returns tuple of (response as list of byte values, bits in the last response byte, processing time
+        in seconds), or None if the tag does not answer.
+        """
+        self.commands += 1
+
+        if bits == 7:
+            if (frame[0] == 0x26 and self.state == self.IDLE) or \
+                    (frame[0] == 0x52 and self.state in (self.IDLE, self.HALT)):
+                self.state = self.READY1
+                return self.ATQA, 8, 0.
+            return None
+
+        if self.state in (self.IDLE, self.HALT):
+            return None
+
+        # anticollision and select, cascade level 1 and 2
+        if frame[:2] == [0x93, 0x20] and self.state == self.READY1:
+            return self.with_bcc([0x88] + self.uid[:3]), 8, 0.
+        if frame[:2] == [0x95, 0x20] and self.state == self.READY2:
+            return self.with_bcc(self.uid[3:]), 8, 0.
+        if frame[:2] == [0x93, 0x70] and self.state == self.READY1:
+            if not self.check_crc(frame) or frame[2:7] != self.with_bcc([0x88] + self.uid[:3]):
+                return None
+            self.state = self.READY2
+            return self.with_crc([0x04]), 8, 0.
+        if frame[:2] == [0x95, 0x70] and self.state == self.READY2:
+            if not self.check_crc(frame) or frame[2:7] != self.with_bcc(self.uid[3:]):
+                return None
+            self.state = self.ACTIVE
+            return self.with_crc([0x00]), 8, 0.
+
+        if self.state != self.ACTIVE:
+            self.state = self.IDLE
+            return None
+
+        # second part of COMPATIBILITY_WRITE: 16 bytes, only the first 4 are written
+        if self.compat_write_page is not None:
+            page = self.compat_write_page
+            self.compat_write_page = None
+            if len(frame) != 18 or not self.check_crc(frame):
+                return [self.NAK_CRC], 4, 0.
+            self.memory[page * 4: page * 4 + 4] = frame[:4]
+            self.writes += 1
+            return [self.ACK], 4, self.write_time
+
+        if not self.check_crc(frame):
+            return [self.NAK_CRC], 4, 0.
+
+        command = frame[0]
+        if command == 0x30 and len(frame) == 4:
+            # READ: 4 pages, rolling over to page 0
+            page = frame[1]
+            if page >= self.N_PAGES:
+                return [self.NAK_ARGUMENT], 4, 0.
+            data = (self.memory * 2)[page * 4: page * 4 + 16]
+            return self.with_crc(data), 8, 0.
+
+        if command == 0x3A and len(frame) == 5:
+            # FAST_READ
+            start_page, end_page = frame[1], frame[2]
+            if start_page > end_page or end_page >= self.N_PAGES:
+                return [self.NAK_ARGUMENT], 4, 0.
+            return self.with_crc(self.page_data(start_page, end_page)), 8, 0.
+
+        if command == 0xA2 and len(frame) == 8:
+            # WRITE
+            page = frame[1]
+            if not self.FIRST_USER_PAGE <= page < self.N_PAGES:
+                return [self.NAK_ARGUMENT], 4, 0.
+            self.memory[page * 4: page * 4 + 4] = frame[2:6]
+            self.writes += 1
+            return [self.ACK], 4, self.write_time
+
+        if command == 0xA0 and len(frame) == 4:
+            # COMPATIBILITY_WRITE, first part
+            page = frame[1]
+            if not self.FIRST_USER_PAGE <= page < self.N_PAGES:
+                return [self.NAK_ARGUMENT], 4, 0.
+            self.compat_write_page = page
+            return [self.ACK], 4, 0.
+
+        if command == 0x50 and len(frame) == 4:
+            # HALT, never answered
+            self.state = self.HALT
+            return None
+
+        self.state = self.IDLE
+        return [self.NAK_ARGUMENT], 4, 0.
+
+    @staticmethod
+    def with_bcc(data):
+        check = 0
+        for byte in data:
+            check ^= byte
+        return list(data) + [check]
+
+    @staticmethod
+    def with_crc(data):
+        return list(data) + crc_a(data)
+
+    @staticmethod
+    def check_crc(frame):
+        return len(frame) > 2 and crc_a(frame[:-2]) == list(frame[-2:])
+
+
+class SimulatedMFRC522(object):
+    """
+    Stand-in for spidev.SpiDev, simulating an MFRC522 at register level with virtual tags in its RF field.
+
+    Transceive commands are started by the StartSend bit and answered by the tags in the field, if the
+    antenna is on. Without an answer, the timer IRQ is raised after the period configured in the timer
+    registers. With air_time set, completion is delayed by the time the frames take at 106 kbit/s, the tag
+    processing time and the timer period, otherwise commands complete immediately. The IRQ pin is driven
+    through the given GPIO stand-in (e.g. FakeGPIO) according to ComIEnReg.
+    """
+
+    CommandReg = 0x01
+    ComIEnReg = 0x02
+    ComIrqReg = 0x04
+    DivIrqReg = 0x05
+    ErrorReg = 0x06
+    FIFODataReg = 0x09
+    FIFOLevelReg = 0x0A
+    ControlReg = 0x0C
+    BitFramingReg = 0x0D
+    TxControlReg = 0x14
+    CRCResultRegM = 0x21
+    CRCResultRegL = 0x22
+    TModeReg = 0x2A
+    TPrescalerReg = 0x2B
+    TReloadRegH = 0x2C
+    TReloadRegL = 0x2D
+
+    mode_idle = 0x00
+    mode_crc = 0x03
+    mode_transrec = 0x0C
+    mode_reset = 0x0F
+
+    # register values after reset
+    reset_values = {0x01: 0x20, 0x02: 0x80, 0x0C: 0x10, 0x11: 0x3F, 0x14: 0x80, 0x21: 0xFF, 0x22: 0xFF}
+
+    fifo_size = 64
+
+    # time per bit at 106 kbit/s, and time between end of a frame and the answer (seconds)
+    bit_time = 1. / 106000.
+    frame_delay = 0.000086
+
+    def __init__(self, gpio=None, pin_irq=0, air_time=True, transfer_us=0):
+        """
+        gpio -- GPIO stand-in to drive the IRQ pin on, None if not connected
+        pin_irq -- GPIO pin connected to the IRQ pin
+        air_time -- delay command completion like a real reader
+        transfer_us -- time to spend in each SPI transfer (microseconds), to model the bus
+        """
+        self.gpio = gpio
+        self.pin_irq = pin_irq
+        self.air_time = air_time
+        self.transfer_us = transfer_us
+        self.is_open = False
+        self.max_speed_hz = 0
+
+        self.lock = threading.RLock()
+        self.registers = [0] * 64
+        self.fifo = []
+
+        # result of the running transceive command: (completion time, response, bits in last byte,
+        # error register value), None if none running
+        self.pending = None
+        self.timer = None
+
+        # tags in the field, and scheduled (time, tag, in field) changes
+        self.tags = []
+        self.schedule = []
+
+        # IRQ pin level
+        self.irq_level = 1
+
+        # number of xfer2 calls and opens, and number of frames sent to tags
+        self.transfers = 0
+        self.opens = 0
+        self.frames = 0
+
+        self.soft_reset()
+
+    def add_tag(self, tag, delay=0., duration=None):
+        """
+        Put tag on the reader after delay seconds, take it off again after duration seconds if given
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.schedule.append((now + delay, tag, True))
+            if duration is not None:
+                self.schedule.append((now + delay + duration, tag, False))
+            self.schedule.sort(key=lambda event: event[0])
+            self.update()
+
+    def remove_tag(self, tag, delay=0.):
+        """
+        Take tag off the reader after delay seconds
+        """
+        with self.lock:
+            self.schedule.append((time.monotonic() + delay, tag, False))
+            self.schedule.sort(key=lambda event: event[0])
+            self.update()
+
+    def open(self, bus=0, device=0):
+        self.is_open = True
+        self.opens += 1
+
+    def close(self):
+        self.is_open = False
+
+    def xfer2(self, data):
+        with self.lock:
+            self.transfers += 1
+            if self.transfer_us > 0:
+                time.sleep(self.transfer_us * 1e-6)
+
+            self.update()
+
+            if data[0] & 0x80:
+                # multi-byte read: each byte sent carries the address for the next byte received
+                out = [0] + [self.read_register((address >> 1) & 0x3F) for address in data[:-1]]
+            else:
+                address = (data[0] >> 1) & 0x3F
+                for value in data[1:]:
+                    self.write_register(address, value)
+                out = [0] * len(data)
+
+            self.update_irq_pin()
+            return out
+
+    def soft_reset(self):
+        self.cancel()
+        self.registers = [0] * 64
+        for address, value in self.reset_values.items():
+            self.registers[address] = value
+        self.fifo = []
+        self.field_changed()
+
+    def antenna_on(self):
+        return (self.registers[self.TxControlReg] & 0x03) == 0x03
+
+    def timer_period(self):
+        """
+        Timer period configured in the timer registers (seconds)
+        """
+        prescaler = ((self.registers[self.TModeReg] & 0x0F) << 8) | self.registers[self.TPrescalerReg]
+        reload = (self.registers[self.TReloadRegH] << 8) | self.registers[self.TReloadRegL]
+        return (2 * prescaler + 1) * (reload + 1) / 13.56e6
+
+    def read_register(self, address):
+        if address == self.FIFODataReg:
+            return self.fifo.pop(0) if self.fifo else 0
+        if address == self.FIFOLevelReg:
+            return len(self.fifo)
+        return self.registers[address]
+
+    def write_register(self, address, value):
+        if address in (self.ComIrqReg, self.DivIrqReg):
+            # bit 7 selects whether the marked bits are set or cleared
+            if value & 0x80:
+                self.registers[address] |= value & 0x7F
+            else:
+                self.registers[address] &= ~value & 0x7F
+            return
+
+        if address == self.FIFODataReg:
+            if len(self.fifo) < self.fifo_size:
+                self.fifo.append(value)
+            return
+
+        if address == self.FIFOLevelReg:
+            if value & 0x80:
+                self.fifo = []
+            return
+
+        if address == self.TxControlReg:
+            antenna_on = self.antenna_on()
+            self.registers[address] = value
+            if antenna_on != self.antenna_on():
+                self.field_changed()
+            return
+
+        self.registers[address] = value
+
+        if address == self.CommandReg:
+            command = value & 0x0F
+            if command == self.mode_reset:
+                self.soft_reset()
+            elif command == self.mode_idle:
+                self.cancel()
+            elif command == self.mode_crc:
+                self.registers[self.CRCResultRegL], self.registers[self.CRCResultRegM] = crc_a(self.fifo)
+                self.fifo = []
+                self.registers[self.DivIrqReg] |= 0x04
+
+        elif address == self.BitFramingReg and value & 0x80 and \
+                (self.registers[self.CommandReg] & 0x0F) == self.mode_transrec:
+            self.transceive(value & 0x07)
+
+    def transceive(self, tx_last_bits):
+        """
+        Send FIFO contents to the tags in the field, schedule completion
+        """
+        frame = self.fifo
+        self.fifo = []
+        self.registers[self.ErrorReg] = 0
+        self.frames += 1
+
+        bits = tx_last_bits if tx_last_bits != 0 else 8
+        duration = ((len(frame) - 1) * 9 + bits + 2) * self.bit_time
+
+        answers = []
+        if self.antenna_on():
+            for tag in self.tags:
+                answer = tag.receive(list(frame), bits)
+                if answer is not None:
+                    answers.append(answer)
+
+        if answers:
+            response, rx_bits, processing = answers[0]
+            error = 0x08 if any(answer[0] != response for answer in answers[1:]) else 0x00
+            duration += self.frame_delay + processing + ((len(response) - 1) * 9 + rx_bits + 2) * self.bit_time
+        else:
+            response, rx_bits, error = None, 0, 0x00
+            duration += self.timer_period()
+
+        self.cancel()
+        self.pending = (time.monotonic() + (duration if self.air_time else 0.), response, rx_bits, error)
+
+        if self.air_time and self.gpio is not None and self.pin_irq != 0:
+            # drive the IRQ pin at completion, even if the host does not access the reader meanwhile
+            self.timer = threading.Timer(duration, self.complete)
+            self.timer.daemon = True
+            self.timer.start()
+
+        self.update()
+
+    def complete(self):
+        with self.lock:
+            self.update()
+            self.update_irq_pin()
+
+    def cancel(self):
+        """
+        Stop the running command
+        """
+        self.pending = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def update(self):
+        """
+        Apply scheduled tag changes and completion of the running command, as far as they are due
+        """
+        now = time.monotonic()
+
+        while self.schedule and self.schedule[0][0] <= now:
+            _, tag, in_field = self.schedule.pop(0)
+            if in_field and tag not in self.tags:
+                tag.power_off()
+                self.tags.append(tag)
+            elif not in_field and tag in self.tags:
+                tag.power_off()
+                self.tags.remove(tag)
+
+        if self.pending is not None and self.pending[0] <= now:
+            _, response, rx_bits, error = self.pending
+            self.pending = None
+            self.registers[self.ErrorReg] = error
+            if response is None:
+                self.registers[self.ComIrqReg] |= 0x01
+            else:
+                self.fifo = list(response[:self.fifo_size])
+                self.registers[self.ControlReg] = (self.registers[self.ControlReg] & 0xF8) | (rx_bits & 0x07)
+                self.registers[self.ComIrqReg] |= 0x20 | (0x02 if error else 0x00)
+
+    def field_changed(self):
+        """
+        RF field switched on or off - tags lose power and return to IDLE
+        """
+        for tag in self.tags:
+            tag.power_off()
+
+    def update_irq_pin(self):
+        if self.gpio is None or self.pin_irq == 0:
+            return
+
+        enabled = self.registers[self.ComIEnReg]
+        asserted = (self.registers[self.ComIrqReg] & enabled & 0x7F) != 0
+        level = 0 if asserted == bool(enabled & 0x80) else 1
+        if level != self.irq_level:
+            self.irq_level = level
+            self.gpio.set_input(self.pin_irq, level)
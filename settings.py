@@ -2,5 +2,26 @@ import os
 
 SERVER_HOST_MASK = os.environ.get('NFCMUSIK_SERVER_HOST', default='0.0.0.0')
 SERVER_PORT = os.environ.get('NFCMUSIK_SERVER_PORT', 5000)
-MUSIC_ROOT = os.environ.get('NFCMUSIK_AUDIO_FILE_ROOT', '~/music')
-DEFAULT_VOLUME = os.environ.get('NFCMUSIK_AUDIO_VOLUME', 70)
+MUSIC_ROOT = os.path.expanduser(os.environ.get('NFCMUSIK_AUDIO_FILE_ROOT', '~/music'))
+DEFAULT_VOLUME = int(os.environ.get('NFCMUSIK_AUDIO_VOLUME', 70))
+MIXER_CONTROL = os.environ.get('NFCMUSIK_MIXER_CONTROL', 'PCM')
+VOLUME_RAMP = float(os.environ.get('NFCMUSIK_VOLUME_RAMP', 0.3))
+RFID_MAX_ERRORS = int(os.environ.get('NFCMUSIK_RFID_MAX_ERRORS', 5))
+RFID_WATCHDOG = float(os.environ.get('NFCMUSIK_RFID_WATCHDOG', 300))
+RFID_HW_CRC = os.environ.get('NFCMUSIK_RFID_HW_CRC', '0') == '1'
+RFID_SHADOW = os.environ.get('NFCMUSIK_RFID_SHADOW', '0') == '1'
+RFID_IRQ_SLEEP_US = int(os.environ.get('NFCMUSIK_RFID_IRQ_SLEEP_US', 300))
+RFID_DETECT_MODE = os.environ.get('NFCMUSIK_RFID_DETECT_MODE', 'poll')
+RFID_PIN_IRQ = int(os.environ.get('NFCMUSIK_RFID_PIN_IRQ', 18))
+RFID_IRQ_REARM = float(os.environ.get('NFCMUSIK_RFID_IRQ_REARM', 0.1))
+STATE_DIR = os.path.expanduser(os.environ.get('NFCMUSIK_STATE_DIR', '~/.nfcmusik'))
+AUDIO_CACHE_MB = float(os.environ.get('NFCMUSIK_AUDIO_CACHE_MB', 32))
+AUDIO_CACHE_HEAD_KB = int(os.environ.get('NFCMUSIK_AUDIO_CACHE_HEAD_KB', 512))
+AUDIO_CACHE_PREFETCH = int(os.environ.get('NFCMUSIK_AUDIO_CACHE_PREFETCH', 8))
+LIBRARY_SCAN_INTERVAL = float(os.environ.get('NFCMUSIK_LIBRARY_SCAN_INTERVAL', 30))
+TRACK_ID_MODE = os.environ.get('NFCMUSIK_TRACK_ID_MODE', 'name')
+METRICS = os.environ.get('NFCMUSIK_METRICS', '1') == '1'
+TRACE_EVENTS = int(os.environ.get('NFCMUSIK_TRACE_EVENTS', 4096))
+SPI_RECORD_DIR = os.path.expanduser(os.environ.get('NFCMUSIK_SPI_RECORD_DIR', ''))
+SPI_RECORD_MB = float(os.environ.get('NFCMUSIK_SPI_RECORD_MB', 64))
+SPI_REPLAY = os.environ.get('NFCMUSIK_SPI_REPLAY', '')
@@ -0,0 +1,364 @@
+import argparse
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from os import path
+
+from rfid_sim import FakeGPIO, SimulatedMFRC522
+
+logger = logging.getLogger(__name__)
+
+"""
+
+Recording of the SPI traffic between rfid.RFID and the MFRC522, and deterministic replay of recordings.
+
+SpiRecorder wraps an SpiDev and appends every transfer to a compact binary file. ReplayMFRC522 is a
+simulated reader that answers the frames sent to tags with the responses from a recording. Replay works
+at frame level, so a reader driver that accesses registers differently, e.g. with fewer transactions,
+still gets the recorded answers as long as it sends the same frames in the same order.
+
+Usage:
+
+    python spirecord.py info <recording>
+    python spirecord.py replay <recording>
+
+"""
+
+# file header: magic and format version
+HEADER = struct.Struct('<4sB')
+MAGIC = b'NFCS'
+VERSION = 1
+
+# transfer record: microseconds since the previous transfer, number of bytes sent;
+# followed by the bytes sent and the same number of bytes received
+RECORD = struct.Struct('<IH')
+
+FIFODataReg = 0x09
+FIFOLevelReg = 0x0A
+CommandReg = 0x01
+ComIrqReg = 0x04
+ErrorReg = 0x06
+ControlReg = 0x0C
+BitFramingReg = 0x0D
+
+mode_crc = 0x03
+mode_transrec = 0x0C
+
+
+class SpiRecorder(object):
+    """
+    Stand-in for spidev.SpiDev that passes all calls on to spi and records the transfers.
+
+    Each process writes its own file spi-<process id>.bin in directory, opened on the first transfer, so
+    that instances inherited by forked processes do not share a file. Recording stops when the file
+    reaches max_bytes.
+    """
+
+    def __init__(self, directory, spi=None, max_bytes=64 * 1024 * 1024, flush_interval=1.):
+        if spi is None:
+            import spidev
+            spi = spidev.SpiDev()
+
+        self.spi = spi
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+
+        # recording file, process it belongs to, bytes written, time of last transfer and of last flush
+        self.file = None
+        self.pid = None
+        self.size = 0
+        self.last_time = 0.
+        self.last_flush = 0.
+
+    @property
+    def max_speed_hz(self):
+        return self.spi.max_speed_hz
+
+    @max_speed_hz.setter
+    def max_speed_hz(self, value):
+        self.spi.max_speed_hz = value
+
+    def open(self, bus=0, device=0):
+        self.spi.open(bus, device)
+
+    def close(self):
+        self.spi.close()
+        if self.file is not None and self.pid == os.getpid():
+            self.file.flush()
+
+    def xfer2(self, data):
+        ret = self.spi.xfer2(data)
+        self.record(data, ret)
+        return ret
+
+    def record(self, sent, received):
+        if self.pid != os.getpid():
+            self.start()
+
+        if self.file is None or self.size >= self.max_bytes:
+            return
+
+        now = time.monotonic()
+        delta_us = min(int((now - self.last_time) * 1e6), 0xFFFFFFFF) if self.last_time else 0
+        self.last_time = now
+
+        record = RECORD.pack(delta_us, len(sent)) + bytes(sent) + bytes(received)
+        self.file.write(record)
+        self.size += len(record)
+
+        if now - self.last_flush > self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def start(self):
+        """
+        Open the recording file of the current process
+        """
+        self.pid = os.getpid()
+        self.file = None
+        self.size = 0
+        self.last_time = 0.
+        file_path = path.join(self.directory, f'spi-{self.pid}.bin')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = open(file_path, 'wb', buffering=64 * 1024)
+            self.file.write(HEADER.pack(MAGIC, VERSION))
+            self.size = HEADER.size
+            logger.info(f"Recording SPI transfers to {file_path}")
+        except OSError as e:
+            logger.warning(f"Could not record SPI transfers to {file_path}: {e}")
+
+
+def read_recording(file_path):
+    """
+    Read recording, returns list of transfers as tuples (microseconds since previous transfer, bytes sent,
+    bytes received). A truncated last record is ignored.
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read()
+
+    if len(content) < HEADER.size or HEADER.unpack_from(content) != (MAGIC, VERSION):
+        raise ValueError(f"Not an SPI recording, or unsupported version: {file_path}")
+
+    transfers = []
+    pos = HEADER.size
+    while pos + RECORD.size <= len(content):
+        delta_us, length = RECORD.unpack_from(content, pos)
+        pos += RECORD.size
+        if pos + 2 * length > len(content):
+            break
+        transfers.append((delta_us, list(content[pos: pos + length]), list(content[pos + length: pos + 2 * length])))
+        pos += 2 * length
+
+    return transfers
+
+
+class Exchange(object):
+    """
+    Frame sent to the tags and the answer seen by the reader, reconstructed from a recording
+    """
+
+    def __init__(self, frame, bits):
+        self.frame = frame
+        self.bits = bits
+
+        # register values read while the command ran or after: first ComIrqReg value with a completion
+        # bit set, then first ErrorReg, FIFOLevelReg and ControlReg values; and response bytes read from the FIFO
+        self.irq = None
+        self.error = None
+        self.level = None
+        self.control = None
+        self.response = []
+
+    def answered(self):
+        return self.irq is not None and (self.irq & 0x20) != 0
+
+    def __repr__(self):
+        return f'Exchange({bytes(self.frame).hex()}/{self.bits} -> ' + \
+               (f'{bytes(self.response).hex()})' if self.answered() else 'no answer)')
+
+
+def extract_exchanges(transfers):
+    """
+    Reconstruct the frames sent to tags and their answers from recorded transfers, returns list of Exchange
+    """
+    exchanges = []
+    fifo = []
+    command = 0
+    current = None
+
+    for _, sent, received in transfers:
+        if not sent:
+            continue
+
+        if sent[0] & 0x80:
+            # multi-byte read: each byte sent carries the address for the next byte received
+            for i, address in enumerate(sent[:-1]):
+                address = (address >> 1) & 0x3F
+                value = received[i + 1]
+                if current is None:
+                    continue
+                if current.irq is None:
+                    if address == ComIrqReg and value & 0x21:
+                        current.irq = value
+                elif address == ErrorReg and current.error is None:
+                    current.error = value
+                elif address == FIFOLevelReg and current.level is None:
+                    current.level = value
+                elif address == ControlReg and current.control is None:
+                    current.control = value
+                elif address == FIFODataReg:
+                    current.response.append(value)
+            continue
+
+        address = (sent[0] >> 1) & 0x3F
+        for value in sent[1:]:
+            if address == FIFODataReg:
+                fifo.append(value)
+            elif address == FIFOLevelReg and value & 0x80:
+                fifo = []
+            elif address == CommandReg:
+                command = value & 0x0F
+                if command == mode_crc:
+                    fifo = []
+            elif address == BitFramingReg and value & 0x80 and command == mode_transrec:
+                current = Exchange(fifo, value & 0x07 or 8)
+                exchanges.append(current)
+                fifo = []
+
+    return exchanges
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+class ReplayMFRC522(SimulatedMFRC522):
+    """
+    Simulated reader answering frames with the responses of a recording, in order.
+
+    Requests for tags that were not answered are skipped if the driver sends something else, so that
+    replay does not depend on how often the driver polled for tags. Any other frame that differs from
+    the recorded one is counted in mismatches (and raises ReplayMismatch with
+    strict set) and is not answered. Frames sent after the end of the recording are not answered either.
+    """
+
+    def __init__(self, exchanges, strict=False, **kwargs):
+        super().__init__(air_time=False, **kwargs)
+        self.exchanges = exchanges
+        self.strict = strict
+
+        # next exchange to replay, frames that differed from the recording, unanswered requests skipped
+        self.position = 0
+        self.mismatches = []
+        self.skipped = 0
+
+        # set once all exchanges were replayed
+        self.done = threading.Event()
+
+    def transceive(self, tx_last_bits):
+        frame = self.fifo
+        self.fifo = []
+        self.registers[self.ErrorReg] = 0
+        self.frames += 1
+        self.cancel()
+
+        response, rx_bits, error = None, 0, 0x00
+        bits = tx_last_bits if tx_last_bits != 0 else 8
+
+        # the driver may have polled for tags less often than in the recording: skip unanswered requests
+        while self.position + 1 < len(self.exchanges) and self.exchanges[self.position].bits == 7 and \
+                not self.exchanges[self.position].answered() and \
+                (self.exchanges[self.position].frame != frame or bits != 7):
+            self.position += 1
+            self.skipped += 1
+
+        if self.position < len(self.exchanges):
+            exchange = self.exchanges[self.position]
+            self.position += 1
+
+            if exchange.frame != frame or exchange.bits != bits:
+                self.mismatches.append((self.position - 1, exchange, frame))
+                if self.strict:
+                    raise ReplayMismatch(f"Frame {self.position - 1}: expected {exchange}, "
+                                         f"got {bytes(frame).hex()}/{bits}")
+            elif exchange.answered():
+                # FIFO bytes the driver did not read are unknown
+                level = max(exchange.level or 0, len(exchange.response))
+                response = exchange.response + [0] * (level - len(exchange.response))
+                rx_bits = (exchange.control or 0) & 0x07 or 8
+                error = exchange.error or 0x00
+
+        if self.position >= len(self.exchanges):
+            self.done.set()
+
+        self.pending = (time.monotonic(), response, rx_bits, error)
+        self.update()
+
+
+def info(file_path):
+    transfers = read_recording(file_path)
+    exchanges = extract_exchanges(transfers)
+    duration = sum(delta_us for delta_us, _, _ in transfers) * 1e-6
+
+    print(f"{len(transfers)} SPI transfers in {duration:.1f} s, {len(exchanges)} frames, "
+          f"{sum(1 for e in exchanges if e.answered())} answered")
+    for exchange in exchanges:
+        print(exchange)
+
+
+def replay(file_path, timeout):
+    """
+    Replay recording against the RFID handler poll loop, compare SPI transactions and frames
+    """
+    import controller
+
+    transfers = read_recording(file_path)
+    exchanges = extract_exchanges(transfers)
+
+    gpio = FakeGPIO()
+    pin_irq = controller.settings.RFID_PIN_IRQ if controller.settings.RFID_DETECT_MODE == 'irq' else 0
+    sim = ReplayMFRC522(exchanges, gpio=gpio, pin_irq=pin_irq)
+
+    handler = controller.RFIDHandler()
+    handler.rfid_kwargs = dict(handler.rfid_kwargs, spi=sim, gpio=gpio)
+
+    thread = threading.Thread(target=handler.poll_loop, daemon=True)
+    thread.start()
+    finished = sim.done.wait(timeout)
+    handler.stop_polling()
+    thread.join()
+
+    print(f"recorded: {len(transfers)} SPI transfers, {len(exchanges)} frames")
+    print(f"replayed: {sim.transfers} SPI transfers, {sim.frames} frames, {sim.skipped} unanswered requests "
+          f"skipped, {len(sim.mismatches)} mismatches"
+          + ("" if finished else " (timed out)"))
+    for index, expected, frame in sim.mismatches[:10]:
+        print(f"  frame {index}: expected {expected}, got {bytes(frame).hex()}")
+
+    return 0 if finished and not sim.mismatches else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay SPI recordings of the RFID reader")
+    parser.add_argument('command', choices=['info', 'replay'])
+    parser.add_argument('recording')
+    parser.add_argument('--timeout', type=float, default=600., help="maximum replay duration (seconds)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == 'info':
+        info(args.recording)
+        return 0
+
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    return replay(args.recording, args.timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
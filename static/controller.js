@@ -1,11 +1,48 @@
-// reload list of music files and render it
+// music file list state: current search string and cursor of the next page (null: no more pages)
+var musicFilesQuery = '';
+var musicFilesCursor = null;
+var musicFilesLoading = false;
+var musicFilesRequest = 0;
+var musicFilesPageSize = 50;
+var musicFilesSearchTimer = null;
+
+// music files queued for batch programming, objects with name and hash
+var batchFiles = [];
+
+
+// reload list of music files from the first page and render it
 function refreshMusicFiles() {
-    $.getJSON('json/musicfiles', function(data) {
-        var fileList = $("#musicFiles");
+    $("#musicFiles").empty();
+    musicFilesCursor = null;
+    musicFilesLoading = false;
+    loadMusicFiles();
+}
 
-        fileList.empty();
 
-        $.each(data, function(i, f) {
+// load next page of music files and append it to the list
+function loadMusicFiles() {
+    // a page is already on its way, don't append it twice
+    if (musicFilesLoading) {
+        return;
+    }
+    musicFilesLoading = true;
+
+    var requestId = ++musicFilesRequest;
+    var params = {q: musicFilesQuery, limit: musicFilesPageSize};
+    if (musicFilesCursor !== null) {
+        params.cursor = musicFilesCursor;
+    }
+
+    $.getJSON('json/library', params, function(data) {
+        // search changed or list reloaded while loading
+        if (requestId !== musicFilesRequest) {
+            return;
+        }
+        musicFilesLoading = false;
+
+        var fileList = $("#musicFiles");
+
+        $.each(data.items, function(i, f) {
             var li = $('<li/>')
                 .attr('id', f.hash)
                 .addClass('musicFileItem')
@@ -18,12 +55,67 @@ function refreshMusicFiles() {
                 .click(function() { writeNFC(f.hash); })
                 .text('write to tag')
                 .appendTo(li);
-                        
+
+            $('<button/>')
+                .attr('type', 'button')
+                .addClass("btn btn-default")
+                .click(function() { addToBatch(f); })
+                .text('add to batch')
+                .appendTo(li);
         });
+
+        musicFilesCursor = data.next;
+        $("#loadMoreMusicFiles").toggle(musicFilesCursor !== null);
+    }).fail(function() {
+        if (requestId === musicFilesRequest) {
+            musicFilesLoading = false;
+        }
     });
 }
 
 
+// load list of playlists (music directories and playlist files) and render it
+function refreshPlaylists() {
+    $.getJSON('json/playlists', function(data) {
+        var playlistList = $("#playlists");
+
+        playlistList.empty();
+
+        $.each(data, function(i, p) {
+            var li = $('<li/>')
+                .attr('id', p.hash)
+                .addClass('musicFileItem')
+                .text(p.name + ' (' + p.files + ' files)   ')
+                .appendTo(playlistList);
+
+            $('<button/>')
+                .attr('type', 'button')
+                .addClass("btn btn-default")
+                .click(function() { writeNFC(p.hash); })
+                .text('write to tag')
+                .appendTo(li);
+
+            $('<button/>')
+                .attr('type', 'button')
+                .addClass("btn btn-default")
+                .click(function() { addToBatch(p); })
+                .text('add to batch')
+                .appendTo(li);
+        });
+    });
+}
+
+
+// search as you type, waiting for a short pause in typing
+function searchMusicFiles(query) {
+    clearTimeout(musicFilesSearchTimer);
+    musicFilesSearchTimer = setTimeout(function() {
+        musicFilesQuery = query;
+        refreshMusicFiles();
+    }, 250);
+}
+
+
 function writeNFC(data) {
     $.getJSON('actions/writenfc?data=' + data, function(ret) {
         setStatus(ret.message);
@@ -31,6 +123,14 @@ function writeNFC(data) {
 }
 
 
+// volume tag payload, as controller.volume_payload(): TLV control byte, record with control byte 0x13,
+// length 2, mode (0 - set, 1 - step) and percent or signed step, terminator
+function writeVolumeTag(mode, amount) {
+    var hex = function(b) { return ('0' + (b & 0xff).toString(16)).slice(-2); };
+    writeNFC('12' + '13' + '02' + hex(mode) + hex(amount) + 'fe');
+}
+
+
 function setStatus(status) {
     var statusBox = $('#statusBox');
     
@@ -42,19 +142,119 @@ function setStatus(status) {
 }
 
 
-function pollNFC(){
-    $.getJSON('json/readnfc', function(data) {
+function showNFCStatus(data) {
+    var nfcStatus = $('#nfcStatusBox');
 
-        var nfcStatus = $('#nfcStatusBox');
+    nfcStatus.empty();
+
+    $('<p/>')
+        .text('NFC Tag Status: ' + data['description'] + ' (UID:' + data['uid'] + ', data: ' + data['data'] + ')')
+        .appendTo(nfcStatus);
+}
 
-        nfcStatus.empty();
 
-        $('<p/>')
-            .text('NFC Tag Status: ' + data['description'] + ' (UID:' + data['uid'] + ', data: ' + data['data'] + ')')
-            .appendTo(nfcStatus);
+// get JSON status from url every second and render it with show
+function pollStatus(url, show) {
+    $.getJSON(url, function(data) {
+
+        show(data);
 
         // poll again in 1 sec
-        setTimeout(pollNFC, 1000);
+        setTimeout(function() { pollStatus(url, show); }, 1000);
+    });
+}
+
+
+// get status changes pushed from the server as events of type eventType from eventUrl and render them with
+// show, fall back to polling pollUrl if not possible
+function watchStatus(eventUrl, eventType, pollUrl, show) {
+    if (!window.EventSource) {
+        pollStatus(pollUrl, show);
+        return;
+    }
+
+    var source = new EventSource(eventUrl);
+
+    source.addEventListener(eventType, function(e) {
+        show(JSON.parse(e.data));
+    });
+
+    source.onerror = function() {
+        // browser reconnects by itself unless the stream was closed for good
+        if (source.readyState === EventSource.CLOSED) {
+            pollStatus(pollUrl, show);
+        }
+    };
+}
+
+
+// render list of music files queued for batch programming
+function showBatchFiles() {
+    var fileList = $("#batchFiles");
+
+    fileList.empty();
+    $.each(batchFiles, function(i, f) {
+        $('<li/>')
+            .text(f.name)
+            .appendTo(fileList);
+    });
+}
+
+
+function addToBatch(f) {
+    batchFiles.push(f);
+    showBatchFiles();
+}
+
+
+function clearBatch() {
+    batchFiles = [];
+    showBatchFiles();
+}
+
+
+// queue batch on the server, tags are then written as they are put on the reader
+function startBatch() {
+    $.ajax({
+        url: 'actions/batch/start',
+        type: 'POST',
+        contentType: 'application/json',
+        dataType: 'json',
+        data: JSON.stringify({data: batchFiles.map(function(f) { return f.hash; })}),
+        success: function(ret) { setStatus(ret.message); },
+        error: function(xhr) { setStatus(xhr.responseJSON ? xhr.responseJSON.message : 'Could not start batch'); }
     });
 }
 
+
+function cancelBatch() {
+    $.getJSON('actions/batch/cancel', function(ret) {
+        setStatus(ret.message);
+    });
+}
+
+
+function showBatchStatus(data) {
+    var batchStatus = $('#batchStatusBox');
+
+    batchStatus.empty();
+
+    if (data['state'] === 'idle') {
+        return;
+    }
+
+    var text = 'Batch: ' + data['state'] + ', ' + data['written'] + ' of ' + data['total'] + ' tags written';
+    if (data['errors'] > 0) {
+        text += ' (' + data['errors'] + ' failed attempts)';
+    }
+    if (data['last'] !== null) {
+        text += ', last: ' + data['last'] + ' (UID:' + data['last_uid'] + ')';
+    }
+    if (data['next'] !== null) {
+        text += ', put next tag on the reader for: ' + data['next'];
+    }
+
+    $('<p/>')
+        .text(text)
+        .appendTo(batchStatus);
+}
@@ -0,0 +1,177 @@
+import ctypes
+import logging
+import os
+import time
+from collections import OrderedDict
+from multiprocessing import RawValue
+from os import path
+
+logger = logging.getLogger(__name__)
+
+"""
+
+Caches for tag contents.
+
+"""
+
+
+class TagContentCache(object):
+    """
+    Tag data by complete tag UID, with time-to-live and least-recently-used eviction. The polling process
+    only uses an entry while its tag stays on the reader, which then only needs request and anticollision
+    at cascade level 1 per poll cycle.
+
+    Entries are only used by the polling process, hit/miss counters are kept in shared memory
+    so that they can be read from the web server as well.
+    """
+
+    def __init__(self, max_entries=64, ttl=30.):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # UID tuple -> (data, time stored)
+        self.entries = OrderedDict()
+
+        self.hits = RawValue(ctypes.c_uint64, 0)
+        self.misses = RawValue(ctypes.c_uint64, 0)
+
+    def get(self, uid):
+        """
+        Get cached data for uid (list of byte values), None if not cached or expired
+        """
+        key = tuple(uid)
+        entry = self.entries.get(key)
+
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+            self.entries.move_to_end(key)
+            self.hits.value += 1
+            return entry[0]
+
+        if entry is not None:
+            del self.entries[key]
+        self.misses.value += 1
+        return None
+
+    def put(self, uid, data):
+        """
+        Store data for uid
+        """
+        key = tuple(uid)
+        self.entries[key] = (list(data), time.monotonic())
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, uid):
+        """
+        Drop entry for uid, if any
+        """
+        self.entries.pop(tuple(uid), None)
+
+    def stats(self):
+        """
+        Get cache statistics as dictionary
+        """
+        return dict(entries=len(self.entries),
+                    hits=self.hits.value,
+                    misses=self.misses.value)
+
+
+class UidMap(object):
+    """
+    Persistent map of complete tag UID (4 or 7 bytes) to tag data, for tags seen before.
+
+    Stored as a header (magic bytes, UID and data length) and a log of fixed-size binary records (UID padded
+    with zero bytes, followed by data) that is appended to on every change, later records override earlier
+    ones. The log is compacted when loading, files with a different header are discarded.
+    """
+
+    MAGIC = b'UIDM'
+    UID_LENGTH = 7
+    DATA_LENGTH = 16
+
+    def __init__(self, file_path, data_length=DATA_LENGTH):
+        self.file_path = file_path
+        self.data_length = data_length
+        self.header = self.MAGIC + bytes([self.UID_LENGTH, data_length])
+        self.record_length = self.UID_LENGTH + self.data_length
+
+        # UID tuple -> data list
+        self.entries = dict()
+
+    def load(self):
+        """
+        Load map from disk and compact the log
+        """
+        self.entries = dict()
+
+        try:
+            with open(self.file_path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Could not read UID map {self.file_path}: {e}")
+            return
+
+        if not content.startswith(self.header):
+            logger.info(f"Discarding UID map {self.file_path} with different format")
+            self.save()
+            return
+
+        content = content[len(self.header):]
+        n_records = len(content) // self.record_length
+        for i in range(n_records):
+            record = content[i * self.record_length: (i + 1) * self.record_length]
+            self.entries[tuple(record[:self.UID_LENGTH])] = list(record[self.UID_LENGTH:])
+
+        if n_records > len(self.entries) or len(content) % self.record_length != 0:
+            self.save()
+
+    def save(self):
+        """
+        Write compacted map to disk
+        """
+        try:
+            os.makedirs(path.dirname(self.file_path), exist_ok=True)
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.header)
+                for uid, data in self.entries.items():
+                    f.write(bytes(uid) + bytes(data))
+            os.replace(tmp_path, self.file_path)
+        except OSError as e:
+            logger.warning(f"Could not write UID map {self.file_path}: {e}")
+
+    def get(self, uid):
+        """
+        Get data last seen on tag uid, None if unknown
+        """
+        return self.entries.get(self.key(uid))
+
+    def put(self, uid, data):
+        """
+        Store data seen on tag uid, appending to the log on disk if it changed
+        """
+        key = self.key(uid)
+        data = list(data[:self.data_length])
+        data += [0] * (self.data_length - len(data))
+        if self.entries.get(key) == data:
+            return
+
+        self.entries[key] = data
+        try:
+            os.makedirs(path.dirname(self.file_path), exist_ok=True)
+            with open(self.file_path, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(self.header)
+                f.write(bytes(key) + bytes(data))
+        except OSError as e:
+            logger.warning(f"Could not write UID map {self.file_path}: {e}")
+
+    def key(self, uid):
+        """
+        Get entry key of uid, padded to UID_LENGTH
+        """
+        return tuple(uid) + (0,) * (self.UID_LENGTH - len(uid))
@@ -0,0 +1,144 @@
+import ctypes
+import struct
+import time
+from multiprocessing import Condition, RawArray, RawValue
+
+"""
+
+Tag and batch programming state shared between the RFID polling process and the web server.
+
+"""
+
+
+class SharedBlock(object):
+    """
+    Fixed-size block of bytes in shared memory, guarded by a sequence counter (seqlock).
+
+    There must be only one writer. The writer increments the counter before and after storing a
+    block, so it is odd while a write is in progress. Readers never block the writer: they copy the
+    block and retry until they saw the same even counter before and after copying.
+
+    The counter only changes when the block changes, readers can block until it does with wait_change().
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.block = RawArray(ctypes.c_ubyte, self.size)
+        self.seq = RawValue(ctypes.c_uint32, 0)
+
+        # notified after each change
+        self.changed = Condition()
+
+    def store(self, block):
+        """
+        Store block (bytes of length self.size) - returns True if it changed
+        """
+        # only writer, can read without checking the counter
+        if block == bytes(self.block):
+            return False
+
+        self.seq.value += 1
+        ctypes.memmove(self.block, block, self.size)
+        self.seq.value += 1
+
+        with self.changed:
+            self.changed.notify_all()
+
+        return True
+
+    def load(self):
+        """
+        Get consistent copy of the block as tuple (bytes, sequence number)
+        """
+        while True:
+            seq = self.seq.value
+            if seq & 0x01:
+                time.sleep(0)
+                continue
+            block = bytes(self.block)
+            if self.seq.value == seq:
+                return block, seq
+
+    def wait_change(self, seq, timeout):
+        """
+        Block until the sequence number differs from seq, or timeout (seconds) passes.
+        Returns True if the state changed.
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: self.seq.value != seq, timeout)
+
+
+class SharedTagState(SharedBlock):
+    """
+    Current tag UID and data in shared memory. The polling process is the only writer.
+    """
+
+    UID_LENGTH = 5
+    DATA_LENGTH = 16
+
+    def __init__(self, data_length=DATA_LENGTH):
+        # tag data bytes stored
+        self.data_length = data_length
+
+        # layout: presence flag, UID, data
+        super().__init__(1 + self.UID_LENGTH + self.data_length)
+
+    def publish(self, uid, data):
+        """
+        Store a full snapshot - uid and data are lists of byte values, or None if no tag is present.
+        Returns True if the state changed.
+        """
+        if uid is None or data is None:
+            block = bytes(self.size)
+        else:
+            block = bytes([1]) + bytes(uid[:self.UID_LENGTH]) + \
+                    bytes(data[:self.data_length]).ljust(self.data_length, b'\x00')
+
+        return self.store(block)
+
+    def snapshot(self):
+        """
+        Get consistent snapshot as tuple (uid, data, sequence number) - uid and data are
+        lists of byte values, or None if no tag is present
+        """
+        block, seq = self.load()
+
+        if block[0] == 0:
+            return None, None, seq
+
+        return list(block[1:1 + self.UID_LENGTH]), list(block[1 + self.UID_LENGTH:]), seq
+
+
+class SharedBatchState(SharedBlock):
+    """
+    Progress of batch tag programming in shared memory. The polling process is the only writer.
+    """
+
+    # batch states
+    IDLE = 0
+    RUNNING = 1
+    DONE = 2
+    CANCELLED = 3
+
+    # layout: batch id, state, number of payloads, number written, number of failed writes, UID written last
+    FORMAT = '<IBHHH5s'
+
+    def __init__(self):
+        super().__init__(struct.calcsize(self.FORMAT))
+
+    def publish(self, batch_id, state, total, written, errors, last_uid):
+        """
+        Store progress - last_uid is a list of byte values, or None if no tag was written yet.
+        Returns True if the state changed.
+        """
+        return self.store(struct.pack(self.FORMAT, batch_id, state, total, written, errors,
+                                      bytes(last_uid or [])))
+
+    def snapshot(self):
+        """
+        Get consistent snapshot as tuple (batch id, state, number of payloads, number written,
+        number of failed writes, UID written last or None, sequence number)
+        """
+        block, seq = self.load()
+        batch_id, state, total, written, errors, last_uid = struct.unpack(self.FORMAT, block)
+        return batch_id, state, total, written, errors, list(last_uid) if written > 0 else None, seq
@@ -1,15 +1,133 @@
+import logging
 import subprocess
+import threading
+import time
 
+logger = logging.getLogger(__name__)
 
-def set_volume(percentage):
+
+class VolumeController(object):
     """
-    Set volume of audio output
+    Volume of audio output, set through one long-lived 'amixer -s' process that reads commands from
+    stdin, instead of starting amixer for every change. Changes are ramped in a background thread.
 
-    :param percentage: audio percentage (0-100), integer
+    The amixer process and the thread are started on first use, in the process using the controller.
     """
 
-    if percentage < 0 or percentage > 100:
-        raise ValueError("Percentage must be in the range 0-100, got " + str(percentage))
+    def __init__(self, control='PCM', ramp_time=0.3, ramp_steps=10):
+        """
+        control -- mixer control to set
+        ramp_time -- duration of volume ramps (seconds), 0 to change the volume at once
+        ramp_steps -- number of steps in a ramp
+        """
+        self.control = control
+        self.ramp_time = ramp_time
+        self.ramp_steps = ramp_steps
+
+        # amixer process, and flag to stop trying to start it after it could not be started
+        self.process = None
+        self.failed = False
+
+        # volume (percent) last sent to the mixer, None if not set yet, and volume to ramp to
+        self.volume = None
+        self.target = None
+
+        # notified when the target changes
+        self.condition = threading.Condition()
+
+        # ramp thread
+        self.thread = None
+
+    def set(self, percentage, ramp=True):
+        """
+        Set volume (percent, 0-100), ramping from the current volume unless ramp is False
+        """
+        if percentage < 0 or percentage > 100:
+            raise ValueError("Percentage must be in the range 0-100, got " + str(percentage))
+
+        percentage = int(percentage)
+
+        with self.condition:
+            self.target = percentage
+            if not ramp or self.ramp_time <= 0 or self.volume is None:
+                self.write(percentage)
+                return
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def step(self, delta):
+        """
+        Change volume by delta percent, limited to 0-100
+        """
+        with self.condition:
+            current = self.target if self.target is not None else 0
+        self.set(min(max(current + delta, 0), 100))
+
+    def run(self):
+        """
+        Ramp thread main loop
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.target != self.volume)
+                start = self.volume
+                target = self.target
+
+            for i in range(1, self.ramp_steps + 1):
+                with self.condition:
+                    # new target, start a new ramp from here
+                    if self.target != target:
+                        break
+                    self.write(round(start + (target - start) * i / self.ramp_steps))
+                time.sleep(self.ramp_time / self.ramp_steps)
+
+    def write(self, percentage):
+        """
+        Send volume to the mixer - call with the condition held
+        """
+        self.volume = percentage
+
+        for _ in range(2):
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            if self.process is None:
+                return
+
+            try:
+                self.process.stdin.write(f'set {self.control} {percentage}%\n'.encode())
+                self.process.stdin.flush()
+                return
+            except OSError as e:
+                logger.warning(f"Lost amixer process, restarting: {e}")
+                self.process = None
+
+    def start(self):
+        """
+        Start amixer process
+        """
+        self.process = None
+        if self.failed:
+            return
+
+        try:
+            self.process = subprocess.Popen(['amixer', '-M', '-s', '-q'], stdin=subprocess.PIPE,
+                                            stdout=subprocess.DEVNULL)
+        except OSError as e:
+            logger.warning(f"Could not start amixer, volume control disabled: {e}")
+            self.failed = True
 
-    # set the volume via amixer
-    subprocess.call(["amixer", "-M", "set", "--", "PCM", str(percentage) + "%"])
+    def close(self):
+        """
+        Stop amixer process
+        """
+        with self.condition:
+            if self.process is not None:
+                try:
+                    self.process.stdin.close()
+                    self.process.wait(timeout=1.)
+                except (OSError, subprocess.TimeoutExpired):
+                    self.process.kill()
+                self.process = None